@@ -92,6 +92,7 @@ class AdductCluster(object):
 		# 			self.MH = t
 		# print "Loaded {} transformations from {}".format(len(self.transformations),self.transformation_file)
 		self.transformations = transformation.load_from_file(self.transformation_file)
+		self.transformation_table = transformation.TransformationTable(self.transformations)
 		self.MH = None
 		for t in self.transformations:
 			if t.name=="M+H":
@@ -120,14 +121,19 @@ class AdductCluster(object):
 		self.Z = {}
 		self.todo = []
 		self.clus_poss = {}
+
+		# the masses of all the peaks under all the transformations
+		transformed_masses = self.transformation_table.transform_peaks(peak_list)	# N x T
+		mh_masses = transformed_masses[:,self.transformations.index(self.MH)].tolist()
+
 		current_id = 0
-		for p in peak_list:
+		for p,mh_mass in zip(peak_list,mh_masses):
 			self.peaks.append(p)
-			c = Cluster(p,self.MH.transform(p),current_id,
+			c = Cluster(p,mh_mass,current_id,
 				mass_tol = self.mass_tol,rt_tol = self.rt_tol)
 			current_id += 1
 			self.clusters.append(c)
-			poss = Possible(c,self.MH,self.MH.transform(p),p.rt)
+			poss = Possible(c,self.MH,mh_mass,p.rt)
 			self.possible[p] = {}
 			self.possible[p] = [poss]
 			self.Z[p] = poss
@@ -136,24 +142,38 @@ class AdductCluster(object):
 		print "Created {} clusters".format(len(self.clusters))
 		self.K = len(self.clusters)
 
+		# Cluster k was made from peak k, and what check() does for one peak and cluster is done
+		# below for one peak and all the clusters at once
+		cluster_M = np.array([cluster.M for cluster in self.clusters])
+		cluster_rt = np.array([cluster.mHPeak.rt for cluster in self.clusters])
+		cluster_intensity = np.array([cluster.mHPeak.intensity for cluster in self.clusters])
+
 		for n in range(len(peak_list)):
 
 			p = peak_list[n]
 			if n%500==0:
 				print "Assigning possible transformations %d/%d" % (n, len(peak_list))
 				sys.stdout.flush()
-				
-			for c in self.clusters:
-				if p is c.mHPeak:
-					continue
-				if self.mh_biggest and p.intensity > c.mHPeak.intensity:
-					continue
-				else:
-					t = self.check(p,c)
-					if not t == None:
-						poss = Possible(c,t,t.transform(p),p.rt)
-						self.possible[p].append(poss)
-						self.clus_poss[c].append(poss)
+
+			ok = np.abs(p.rt - cluster_rt) <= self.rt_tol
+			ok[n] = False
+			if self.mh_biggest:
+				ok &= p.intensity <= cluster_intensity
+			candidates = np.flatnonzero(ok)
+			if len(candidates) == 0:
+				continue
+
+			# the first transformation that matches the mass of each candidate cluster
+			tm = transformed_masses[n][:,None]
+			M = cluster_M[candidates]
+			match = np.abs((tm - M)/M)*1e6 < self.mass_tol	# T x C
+			first = match.argmax(axis=0)
+			for i in np.flatnonzero(match.any(axis=0)):
+				c = self.clusters[candidates[i]]
+				t = self.transformations[first[i]]
+				poss = Possible(c,t,transformed_masses[n,first[i]],p.rt)
+				self.possible[p].append(poss)
+				self.clus_poss[c].append(poss)
 
 
 		for p in peak_list:
@@ -262,7 +282,7 @@ class AdductCluster(object):
 			post = []
 			for poss in self.possible[p]:
 				new_post = poss.cluster.compute_rt_like(p.rt)
-				new_post += poss.cluster.compute_mass_like(poss.transformation.transform(p))
+				new_post += poss.cluster.compute_mass_like(poss.transformed_mass)
 				new_post += np.log(poss.cluster.N + (1.0*self.alpha)/(1.0*self.K))
 				post.append(new_post)
 				if new_post > post_max:
@@ -302,10 +322,10 @@ class AdductCluster(object):
 		if np.abs(peak.rt - cluster.mHPeak.rt) > self.rt_tol:
 			return None
 		else:	
-			for t in self.transformations:
-				tm = t.transform(peak)
-				if np.abs((tm - cluster.M)/cluster.M)*1e6 < self.mass_tol:
-					return t
+			tm = self.transformation_table.transform([peak.mass])[0]
+			match = np.flatnonzero(np.abs((tm - cluster.M)/cluster.M)*1e6 < self.mass_tol)
+			if len(match) > 0:
+				return self.transformations[match[0]]
 			return None
 
 	def map_assign(self):
@@ -4,6 +4,7 @@ from scipy.special import psi
 
 import numpy as np
 import plotting
+import utils
 import scipy.sparse as sp
 
 
@@ -12,6 +13,8 @@ class ContinuousGibbs:
 	def __init__(self,peak_data,hyper_pars):
 		self.possible = peak_data.possible
 		self.transformed = peak_data.transformed
+		# possible and transformed share one CSR pattern, the clusters that peak n may go into
+		# are at utils.get_row(possible, n) and their transformed masses in transformed.data there
 		self.n_samples = 20
 		self.n_burn = 10
 		self.hyper_pars = hyper_pars
@@ -56,7 +59,7 @@ class ContinuousGibbs:
 		Znk = np.arange(self.n_peaks)[:,None]
 		Znk = Znk * 0
 
-		todo = np.nonzero((self.possible>0).sum(1)>1)[0]
+		todo = np.flatnonzero(utils.get_row_sizes(self.possible)>1)
 		print str(todo.size) + " peaks to be re-sampled"
 		for samp in np.arange(self.n_samples):
 			if samp%1 == 0:
@@ -65,7 +68,7 @@ class ContinuousGibbs:
 
 			# for i in np.arange(todo.size):
 			for i in np.arange(todo.size):
-				peak = todo[0,i]
+				peak = todo[i]
 				current_cluster = Znk[peak]
 				self.cluster_size[current_cluster]-=1
 				self.cluster_rt_sum[current_cluster]-=self.rt[peak]
@@ -74,7 +77,7 @@ class ContinuousGibbs:
 				# Assign to a random cluster
 
 				# possible_clusters = np.nonzero(self.possible[peak,:])[1]
-				possible_clusters = self.possible.getrowview(peak).nonzero()[1]
+				possible_clusters = utils.get_possible_clusters(self.possible,peak)
 				like = np.log((self.hyper_pars.alpha/self.n_peaks) + self.cluster_size[possible_clusters])
 				like += self._comp_rt_like(peak,possible_clusters)
 				like += self._comp_mass_like(peak,possible_clusters)
@@ -97,10 +100,10 @@ class ContinuousGibbs:
 		self.Z /= (self.n_samples-self.n_burn)
 
 		# This sets the probabilities to one for the peaks that were not resampled
-		not_done = np.nonzero((self.possible>0).sum(1)==1)[0]
+		not_done = np.flatnonzero(utils.get_row_sizes(self.possible)==1)
 		for i in np.arange(not_done.size):
-			peak = not_done[0,i]
-			cluster = self.possible.getrowview(peak).nonzero()[1]
+			peak = not_done[i]
+			cluster = utils.get_possible_clusters(self.possible,peak)
 			self.Z[peak,cluster] = 1.0
 
 		# we also need a consistent set of cluster precursor masses with precisions
@@ -115,7 +118,9 @@ class ContinuousGibbs:
 		posterior_precision = self.hyper_pars.mass_prior_prec + self.hyper_pars.mass_prec*self.cluster_size[possible_clusters]
 		posterior_mean = (1.0/posterior_precision)*(self.hyper_pars.mass_prior_prec*self.prior_mass[possible_clusters] + self.hyper_pars.mass_prec*self.cluster_mass_sum[possible_clusters])
 		predictive_precision = 1.0/(1.0/posterior_precision + 1.0/self.hyper_pars.mass_prec)
-		return self._log_of_norm_pdf(self.transformed[peak,possible_clusters].toarray().T,posterior_mean,predictive_precision)
+		# possible_clusters is always the whole row of peak
+		transformed = self.transformed.data[utils.get_row(self.possible,peak)][:,None]
+		return self._log_of_norm_pdf(transformed,posterior_mean,predictive_precision)
 
 	def _comp_rt_like(self,peak,possible_clusters):
 		posterior_precision = self.hyper_pars.rt_prior_prec + self.hyper_pars.rt_prec*self.cluster_size[possible_clusters]
@@ -154,15 +159,14 @@ class ContinuousVB:
 
 		# Find the peaks that we need to re-sample
 
-		todo = np.nonzero((self.possible>0).sum(1)>1)[0]
+		todo = np.flatnonzero(utils.get_row_sizes(self.possible)>1)
 		print str(todo.size) + " peaks to be re-sampled"
 
 		# self.Z = sp.identity(self.n_peaks,format="lil")		  
 		# N != K now, so initially put peaks into any bin that fits
 		self.Z = sp.lil_matrix((self.n_peaks, self.k_clusters),dtype=np.float) 
 		for n in range(self.n_peaks):
-			possible_clusters = np.nonzero(self.possible[n, :])[1]
-			k = possible_clusters[0]
+			k = utils.get_possible_clusters(self.possible,n)[0]
 			self.Z[n, k] = 1
 
 		# print "Started inefficient matrix nonsense"
@@ -213,13 +217,14 @@ class ContinuousVB:
 
 			for i in np.arange(todo.size):
 				
-				thisRow = todo[0,i]
-				thisPos = self.possible.getrowview(thisRow).nonzero()[1]
+				thisRow = todo[i]
+				row = utils.get_row(self.possible,thisRow)
+				thisPos = self.possible.indices[row]
 				
 				temp = self.ELogPi[thisPos].T
 				
 				# thisRT = np.array(self.matRT[thisRow,thisPos].toarray())
-				thisTr = np.array(self.transformed.getrowview(thisRow).data[0])[:,None].T
+				thisTr = self.transformed.data[row][None,:]
 				thisRT = np.tile(self.rt[thisRow],(1,thisTr.size))
 				
 
@@ -6,6 +6,7 @@ from scipy.special import psi
 
 import numpy as np
 import plotting
+import utils
 import scipy.sparse as sp
 
 
@@ -21,6 +22,9 @@ class DiscreteGibbs:
         self.bins = peak_data.bins
         self.matRT = peak_data.matRT            
 
+        # possible and matRT share one CSR pattern, the bins that peak n may go into are
+        # at utils.get_row(possible, n) and their RTs in matRT.data at the same positions
+
         self.n_samples = 20
         self.n_burn = 10
         self.alpha = float(hyperpars.alpha)
@@ -41,8 +45,7 @@ class DiscreteGibbs:
         Znk = {}
         for n in range(len(self.features)):
             f = self.features[n]
-            possible_clusters = np.nonzero(self.possible[n, :])[1]
-            k = possible_clusters[0]
+            k = utils.get_possible_clusters(self.possible, n)[0]
             any_bin = self.bins[k]
             any_bin.add_feature(f)
             Znk[f] = any_bin
@@ -63,7 +66,8 @@ class DiscreteGibbs:
                 
                 # find possible target clusters
                 current_bin = Znk[f]
-                possible_clusters = np.nonzero(self.possible[n, :])[1]
+                row = utils.get_row(self.possible, n)
+                possible_clusters = self.possible.indices[row]
                 if len(possible_clusters) == 1:
                     # no reassignment to be done if only 1 possible cluster
                     if s >= self.n_burn:
@@ -76,7 +80,7 @@ class DiscreteGibbs:
                 # perform reassignment of peak to bin
                 idx = list(possible_clusters)
                 matching_bins = [self.bins[k] for k in idx]
-                possible_precursor_rts = [self.matRT[n, k] for k in idx]
+                possible_precursor_rts = self.matRT.data[row]
 
                 log_posts = []
                 for k in range(len(matching_bins)):
@@ -175,15 +179,14 @@ class DiscreteVB:
         for n in range(self.n_peaks):
             if n%200 == 0:
                 sys.stdout.write('.')                                         
-            possible_clusters = np.nonzero(self.possible[n, :])[1]
-            k = possible_clusters[0]
+            k = utils.get_possible_clusters(self.possible, n)[0]
             self.Z[n, k] = 1
         print
                     
     def run(self):
 
         # Find peaks with more than 1 possible clusters to reassign
-        todo = np.nonzero((self.possible>0).sum(1)>1)[0]
+        todo = np.flatnonzero(utils.get_row_sizes(self.possible)>1)
         print str(todo.size) + " peaks to be re-sampled"
                     
         for it in range(self.n_iterations):
@@ -212,12 +215,11 @@ class DiscreteVB:
             oldQZ = sp.lil_matrix(self.Z,copy=True)    
             for i in range(todo.size):
 
-                this_row = todo[0, i]
-                this_pos = self.possible.getrowview(this_row).nonzero()[1]
+                this_row = todo[i]
+                this_pos = utils.get_possible_clusters(self.possible, this_row)
 
                 # this_RT = np.array(self.matRT[this_row,this_pos].toarray())
-                this_possible = np.array(self.possible.getrowview(this_row).data[0])[:, None].T
-                this_RT = np.tile(self.rt[this_row],(1, this_possible.size))
+                this_RT = np.tile(self.rt[this_row],(1, this_pos.size))
                 
                 temp = E_log_theta[this_pos].T              
                 temp += -0.5 * self.delta * np.square(this_RT)
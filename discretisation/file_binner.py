@@ -1,9 +1,100 @@
-import numpy as np
-import scipy.sparse as sp
+import multiprocessing
+import os
+import shutil
 import sys
+import tempfile
+
+import numpy as np
 
 import utils
-from models import DiscreteInfo, PrecursorBin
+from models import DiscreteInfo, MatrixBuilder, PrecursorBin
+from mulsubs.transformation import TransformationTable
+
+# the arguments shared by all the files, set once in each worker process of process_files()
+_worker_args = None
+
+def _init_worker(args):
+    global _worker_args
+    _worker_args = args
+
+def _process_file_worker(args):
+    # bins one file and hands its arrays back through .npy files rather than the pickle pipe. 
+    # The concrete bins are cheaper to make again than to pickle, so only the position of their 
+    # abstract bin and their mass, RT and intensity are saved with the arrays, in their order.
+    j, peak_data = args
+    abstract_bins, trans_list, MH, within_file_mass_tol, within_file_rt_tol, out_dir = _worker_args
+    binning = _process_file(j, peak_data, abstract_bins, trans_list, MH,
+                            within_file_mass_tol, within_file_rt_tol)
+    path = os.path.join(out_dir, 'file_%d' % j)
+    binning.save_arrays(path)
+    positions = dict((bin_id, i) for i, (bin_id, features) in enumerate(abstract_bins))
+    np.save(os.path.join(path, 'bin_sources.npy'), 
+            np.array([positions[bb.top_id] for bb in binning.bins], dtype=np.int64))
+    np.save(os.path.join(path, 'bin_values.npy'), 
+            np.array([(bb.mass, bb.rt, bb.intensity) for bb in binning.bins], dtype=np.float64).reshape(-1, 3))
+    return path
+
+def _load_concrete_bins(path, j, abstract_bins, T, within_file_mass_tol, within_file_rt_tol):
+    # makes again the concrete bins saved by _process_file_worker, in the same order
+    sources = np.load(os.path.join(path, 'bin_sources.npy')).tolist()
+    values = np.load(os.path.join(path, 'bin_values.npy')).tolist()
+    return [_make_concrete_bin(k, mass, rt, intensity, abstract_bins[source][0], j, T,
+                               within_file_mass_tol, within_file_rt_tol)
+            for k, (source, (mass, rt, intensity)) in enumerate(zip(sources, values))]
+
+def process_files(data_list, abstract_bins, trans_list, MH,
+                  within_file_mass_tol, within_file_rt_tol, n_processes=None, out_dir=None):
+    ''' 
+    Bins all the files in data_list concurrently, since they only share the abstract bins.
+    
+    Args:
+     - data_list: a list of PeakData, one per file
+     - abstract_bins: a dictionary of the features of every abstract bin, keyed by bin id
+     - trans_list, MH, within_file_mass_tol, within_file_rt_tol: as in _process_file()
+     - n_processes: the number of worker processes, all the CPUs by default. With 1, the files 
+       are binned one by one in this process.
+     - out_dir: the directory where the workers save the arrays of each file. The arrays stay 
+       there, memory-mapped by the results. By default a temporary directory is used and 
+       removed once the arrays are mapped.
+
+    Returns:
+     a list of the DiscreteInfo of every file, in the same order as data_list
+    '''
+    # the abstract bins are walked in this order everywhere, since the order of a dictionary 
+    # may change once it's been pickled to a worker
+    abstract_bins = list(abstract_bins.items())
+    if n_processes is None:
+        n_processes = multiprocessing.cpu_count()
+    n_processes = min(n_processes, len(data_list))
+    if n_processes <= 1:
+        return [_process_file(j, peak_data, abstract_bins, trans_list, MH, 
+                              within_file_mass_tol, within_file_rt_tol) 
+                for j, peak_data in enumerate(data_list)]
+
+    temporary = out_dir is None
+    if temporary:
+        out_dir = tempfile.mkdtemp(prefix='file_binner_')
+    try:
+        shared = (abstract_bins, trans_list, MH, within_file_mass_tol, within_file_rt_tol, out_dir)
+        pool = multiprocessing.Pool(n_processes, initializer=_init_worker, initargs=(shared,))
+        try:
+            paths = pool.map(_process_file_worker, list(enumerate(data_list)), chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        binnings = []
+        for j, path in enumerate(paths):
+            bins = _load_concrete_bins(path, j, abstract_bins, len(trans_list), 
+                                       within_file_mass_tol, within_file_rt_tol)
+            prior_masses = np.array([bb.mass for bb in bins])[:, None]     # K x 1
+            prior_rts = np.array([bb.rt for bb in bins])[:, None]          # K x 1
+            binnings.append(DiscreteInfo.load_arrays(path, bins, prior_masses, prior_rts))
+        return binnings
+    finally:
+        # the memory maps stay valid after their files are removed
+        if temporary:
+            shutil.rmtree(out_dir, ignore_errors=True)
 
 def _process_file(j, peak_data, abstract_bins, trans_list, MH,
                   within_file_mass_tol, within_file_rt_tol):
@@ -20,12 +111,10 @@ def _process_file(j, peak_data, abstract_bins, trans_list, MH,
     prior_intensities = np.array([bb.intensity for bb in concrete_bins])[:, None]      # K x 1
 
     # build the matrices for this file    
-    matRT, possible, transformed = _populate_matrices(j, N, K, 
-                                                      prior_masses, prior_rts, prior_intensities,
-                                                      features, trans_list, 
-                                                      within_file_mass_tol, within_file_rt_tol)                
-
-    binning = DiscreteInfo(possible, transformed, matRT, concrete_bins, prior_masses, prior_rts)
+    binning = _populate_matrices(j, N, K, concrete_bins,
+                                 prior_masses, prior_rts, prior_intensities,
+                                 features, trans_list, 
+                                 within_file_mass_tol, within_file_rt_tol)                
     return binning
 
 def _create_concrete_bins_of_file(j, abstract_bins, 
@@ -36,68 +125,83 @@ def _create_concrete_bins_of_file(j, abstract_bins,
     T = len(trans_list)
     concrete_bins = []
     k = 0
-    for bin_id in abstract_bins:
+    for bin_id, features in abstract_bins:
                         
         # get features previously assigned to this abstract bin
-        features = abstract_bins[bin_id]
-        for f in features:
+        precursor_masses = TransformationTable([MH]).transform_peaks(features)[:, 0].tolist()
+        for f, precursor_mass in zip(features, precursor_masses):
             # and make a new concrete bin from the feature based on mass and RT
-            precursor_mass = MH.transform(f)
-            concrete_bin = PrecursorBin(k, precursor_mass, f.rt, f.intensity, 
-                                        within_file_mass_tol, within_file_rt_tol)
-            concrete_bin.top_id = bin_id
-            concrete_bin.origin = j
-            concrete_bin.T = T
-            concrete_bin.word_counts = np.zeros(T)
-            concrete_bins.append(concrete_bin)
+            concrete_bins.append(_make_concrete_bin(k, precursor_mass, f.rt, f.intensity, bin_id, j, T,
+                                                    within_file_mass_tol, within_file_rt_tol))
             k += 1
             
     return concrete_bins
+
+def _make_concrete_bin(k, mass, rt, intensity, bin_id, j, T, within_file_mass_tol, within_file_rt_tol):
+    concrete_bin = PrecursorBin(k, mass, rt, intensity, within_file_mass_tol, within_file_rt_tol)
+    concrete_bin.top_id = bin_id
+    concrete_bin.origin = j
+    concrete_bin.T = T
+    concrete_bin.word_counts = np.zeros(T)
+    return concrete_bin
             
-def _populate_matrices(j, N, K, 
+def _populate_matrices(j, N, K, concrete_bins,
                        prior_masses, prior_rts, prior_intensities,
                        features, trans_list,
                        within_file_mass_tol, within_file_rt_tol):
 
-    matRT = sp.lil_matrix((N, K), dtype=np.float)       # N x K, RTs of f n in bin k
-    possible = sp.lil_matrix((N, K), dtype=np.int)      # N x K, transformation id+1 of f n in bin k
-    transformed = sp.lil_matrix((N, K), dtype=np.float) # N x K, transformed masses of f n in bin k
-    
-    for n in range(N):
-        
-        if n%1000 == 0:
-            sys.stdout.write(str(j)+' ')                            
-            sys.stdout.flush()
-
-        f = features[n]    
-        current_mass, current_rt, current_intensity = f.mass, f.rt, f.intensity
-
-        transformed_masses = []
-        for trans in trans_list:
-            t_mass = trans.transform(f)
-            transformed_masses.append(t_mass)
-        transformed_masses = np.array(transformed_masses)
-
-        rt_ok = utils.rt_match(current_rt, prior_rts, within_file_rt_tol)
-        intensity_ok = (current_intensity <= prior_intensities)
-        for t in np.arange(len(trans_list)):
-            # fill up the target bins that this transformation allows
-            mass_ok = utils.mass_match(transformed_masses[t], prior_masses, within_file_mass_tol)
-            check = mass_ok*rt_ok*intensity_ok
-            pos = np.flatnonzero(check)
-            # print (f.feature_id, t, pos)
-            possible[n, pos] = t+1
-            # and other prior values too
-            transformed[n, pos] = transformed_masses[t]
-            matRT[n, pos] = current_rt            
-            
-        possible_clusters = np.nonzero(possible[n, :])[1]
-        assert len(possible_clusters) > 0, str(f) + " has no possible clusters"
+    sys.stdout.write(str(j)+' ')                            
+    sys.stdout.flush()
+
+    transformed_masses = TransformationTable(trans_list).transform_peaks(features)     # N x T
+    current_rts = np.array([f.rt for f in features])
+    current_intensities = np.array([f.intensity for f in features])
+    binning = match_bins(transformed_masses, current_rts, current_intensities,
+                         concrete_bins, prior_masses, prior_rts, prior_intensities, 
+                         within_file_mass_tol, within_file_rt_tol)
+
+    no_clusters = np.flatnonzero(utils.get_row_sizes(binning) == 0)
+    assert len(no_clusters) == 0, str(features[no_clusters[0]]) + " has no possible clusters"
         
     print                           
-    return matRT, possible, transformed
+    return binning
+
+def match_bins(transformed_masses, rts, intensities, 
+               bins, prior_masses, prior_rts, prior_intensities,
+               within_file_mass_tol, within_file_rt_tol):
+    ''' 
+    Matches the features of a file against the precursor bins of that file.
+    
+    Args:
+     - transformed_masses: N x T, the mass of every feature under every transformation
+     - rts, intensities: the N RTs and intensities of the features
+     - bins: the K PrecursorBin
+     - prior_masses, prior_rts, prior_intensities: K x 1, the mass, RT and intensity of the bins
+     - within_file_mass_tol, within_file_rt_tol: the tolerances used to match a feature to a bin
+
+    Returns:
+     the DiscreteInfo of the file
+    '''
+    
+    # feature n may go into bin k under transformation t if its transformed mass matches the bin 
+    # mass, its RT the bin RT and it's not more intense than the bin. All the transformed masses 
+    # are matched at once against the sorted bin masses, query q being feature q/T under 
+    # transformation q%T, then the RT and intensity are only checked for the pairs found.
+    N, T = transformed_masses.shape
+    K = len(prior_masses)
+    query, pos = utils.mass_window_join(transformed_masses, prior_masses, within_file_mass_tol)
+    n, t = query / T, query % T
+    check = utils.rt_match(rts[n], np.ravel(prior_rts)[pos], within_file_rt_tol)
+    check &= (intensities[n] <= np.ravel(prior_intensities)[pos])
+    n, t, pos = n[check], t[check], pos[check]
+
+    # when several transformations of a feature match the same bin, the last one is kept
+    builder = MatrixBuilder(N, K)
+    builder.add(n, pos, t+1, transformed_masses[n, t], rts[n])
+    return builder.build(bins, prior_masses, prior_rts)
             
-def _make_precursor_bin(bin_id, bin_mass, bin_RT, bin_intensity, mass_tol, rt_tol):
+def make_precursor_bin(bin_id, bin_mass, bin_RT, bin_intensity, mass_tol, rt_tol):
+    ''' Returns a PrecursorBin, the mass, RT and intensity being scalars or 1-element arrays '''
     bin_mass = utils.as_scalar(bin_mass)
     bin_RT = utils.as_scalar(bin_RT)
     bin_intensity = utils.as_scalar(bin_intensity)
@@ -1,6 +1,8 @@
 from collections import namedtuple
+import os
 
 import numpy as np
+import scipy.sparse as sp
 import utils
 
 
@@ -71,7 +73,114 @@ class Feature(object):
         return "id=(%d,%d) mass=%.4f rt=%.2f int=%.2f" % (self.feature_id, self.file_id, self.mass, self.rt, self.intensity)
 
 Transformation = namedtuple('Transformation', ['trans_id', 'name', 'sub', 'mul', 'iso'])
-DiscreteInfo = namedtuple('DiscreteInfo', ['possible', 'transformed', 'matRT', 'bins', 'prior_masses', 'prior_rts'])
+class DiscreteInfo(object):
+
+    # the arrays written by save_arrays(), in the order of the constructor arguments
+    ARRAYS = ['indptr', 'indices', 'trans_ids', 'transformed_masses', 'rts']
+    
+    def __init__(self, indptr, indices, trans_ids, transformed_masses, rts, bins, prior_masses, prior_rts):
+        ''' 
+        The bins that N features may go into, out of K bins. The possible, transformed and matRT 
+        matrices have the same sparsity, so they're stored as one CSR pattern (indptr, indices) 
+        and a value array each: trans_ids is the transformation id+1, transformed_masses the 
+        transformed mass and rts the RT of feature n in bin k, for every entry of the pattern.
+        '''
+        self.indptr = indptr
+        self.indices = indices
+        self.trans_ids = np.asarray(trans_ids, dtype=np.int16)
+        self.transformed_masses = np.asarray(transformed_masses, dtype=np.float64)
+        self.rts = np.asarray(rts, dtype=np.float32)
+        self.bins = bins
+        self.prior_masses = prior_masses
+        self.prior_rts = prior_rts
+        self.shape = (len(indptr)-1, len(bins))
+
+    @property
+    def possible(self):
+        ''' N x K, transformation id+1 of feature n in bin k '''
+        return self._get_matrix(self.trans_ids)
+
+    @property
+    def transformed(self):
+        ''' N x K, transformed masses of feature n in bin k '''
+        return self._get_matrix(self.transformed_masses)
+
+    @property
+    def matRT(self):
+        ''' N x K, RTs of feature n in bin k '''
+        return self._get_matrix(self.rts)
+
+    def save_arrays(self, path):
+        ''' Saves the pattern and value arrays as .npy files in the directory path '''
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in DiscreteInfo.ARRAYS:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+
+    @staticmethod
+    def load_arrays(path, bins, prior_masses, prior_rts):
+        ''' Makes a DiscreteInfo over the arrays saved in the directory path, memory-mapped '''
+        arrays = [np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in DiscreteInfo.ARRAYS]
+        return DiscreteInfo(*(arrays + [bins, prior_masses, prior_rts]))
+
+    def _get_matrix(self, data):
+        # a CSR matrix over the arrays of this object, without copying them
+        return sp.csr_matrix((data, self.indices, self.indptr), shape=self.shape, copy=False)
+
+    def __repr__(self):
+        return "DiscreteInfo features=%d bins=%d entries=%d" % (self.shape[0], self.shape[1], len(self.indices))
+
+class MatrixBuilder(object):
+    
+    def __init__(self, N, K):
+        ''' 
+        Accumulates the (feature, bin) entries of the possible, transformed and matRT matrices 
+        of N features and K bins as arrays, and builds the DiscreteInfo holding all three at the end.
+        '''
+        self.N = N
+        self.K = K
+        self.rows = []
+        self.cols = []
+        self.possible = []
+        self.transformed = []
+        self.rts = []
+
+    def add(self, rows, cols, possible, transformed, rts):
+        ''' 
+        Adds entries for features rows in bins cols, with values possible (transformation id+1),
+        transformed (transformed masses) and rts. Scalars are broadcast to the other arguments.
+        If the same (feature, bin) pair is added more than once, the last one added is kept.
+        '''
+        arrays = np.broadcast_arrays(rows, cols, possible, transformed, rts)
+        for values, array in zip([self.rows, self.cols, self.possible, self.transformed, self.rts], arrays):
+            values.append(np.ravel(array))
+
+    def build(self, bins, prior_masses, prior_rts):
+        ''' Returns the DiscreteInfo of the entries added, with the K bins and their prior masses and RTs '''
+        if len(self.rows) == 0:
+            self.add([], [], [], [], [])
+        rows = np.concatenate(self.rows).astype(np.int64)
+        cols = np.concatenate(self.cols).astype(np.int64)
+
+        # sort by (row, col) and keep the last entry added of each pair
+        key = rows*self.K + cols
+        order = np.argsort(key, kind='mergesort')
+        key = key[order]
+        last = np.ones(len(key), dtype=bool)
+        last[:-1] = key[1:] != key[:-1]
+        order = order[last]
+
+        # the index type that scipy picks, so the CSR matrices can use the arrays as they are
+        if max(len(order), self.N, self.K) < 2**31:
+            idx_dtype = np.int32
+        else:
+            idx_dtype = np.int64
+        indptr = np.zeros(self.N+1, dtype=idx_dtype)
+        np.cumsum(np.bincount(rows[order], minlength=self.N), out=indptr[1:])
+        indices = cols[order].astype(idx_dtype)
+        return DiscreteInfo(indptr, indices, np.concatenate(self.possible)[order], 
+                            np.concatenate(self.transformed)[order], np.concatenate(self.rts)[order],
+                            bins, prior_masses, prior_rts)
     
 class PeakData(object):
     
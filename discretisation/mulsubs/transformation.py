@@ -1,3 +1,5 @@
+import numpy as np
+
 ELECTRON_MASS = 0.00054857990924
 
 class Transformation(object):
@@ -21,6 +23,44 @@ class Transformation(object):
 	def __repr__(self):
 		return self.__str__()
 
+class TransformationTable(object):
+	# The parameters of a list of transformations as arrays, to transform many masses by all of 
+	# them at once. The transformations can be Transformation objects or the Transformation 
+	# namedtuples of models.py, whose precursor mass is (mass - sub)/mul + iso.
+	def __init__(self,transformations):
+		self.transformations = list(transformations)
+		params = [self._get_params(t) for t in self.transformations]
+		charge,multiplicity,adduct_mass,fragment_mass,electron_mass,isotope_diff = zip(*params) if params else [()]*6
+		self.charge = np.array(charge,dtype=np.float)
+		self.multiplicity = np.array(multiplicity,dtype=np.float)
+		self.adduct_mass = np.array(adduct_mass,dtype=np.float)
+		self.fragment_mass = np.array(fragment_mass,dtype=np.float)
+		self.electron_mass = np.array(electron_mass,dtype=np.float)
+		self.isotope_diff = np.array(isotope_diff,dtype=np.float)
+
+	def _get_params(self,t):
+		# checked by attribute, since a Transformation of this module imported under another 
+		# name is not an instance of this Transformation
+		if hasattr(t,'adduct_mass'):
+			return (t.charge,t.multiplicity,t.adduct_mass,t.fragment_mass,t.charge*ELECTRON_MASS,t.isotope_diff)
+		else:
+			return (1,t.mul,t.sub,0,0,-t.iso)
+
+	def transform(self,masses):
+		# Returns the N x T matrix of the N masses transformed by the T transformations, with the 
+		# operations in the same order as Transformation.transform so the results are identical
+		masses = np.asarray(masses,dtype=np.float).ravel()
+		M = masses[:,None]*self.charge + self.fragment_mass + self.electron_mass - self.adduct_mass
+		M /= self.multiplicity
+		M -= self.isotope_diff
+		return M
+
+	def transform_peaks(self,peaks):
+		return self.transform([p.mass for p in peaks])
+
+	def __len__(self):
+		return len(self.transformations)
+
 def load_from_file(file_name):
 	import yaml,re
 	transformations = []
@@ -47,8 +47,11 @@ class ClusterPlotter(object):
         print "Size: count"
         for i in np.arange(0,si.max()+1):
             print str(i) + ": " + str((si==i).sum())
-        t = (self.peak_data.possible.multiply(self.cluster_membership)).data
-        t -= 1
+        # the transformation of every (peak, cluster) member, read along the pattern of possible
+        possible = self.peak_data.possible
+        rows = np.repeat(np.arange(possible.shape[0]), np.diff(possible.indptr))
+        members = np.asarray(self.cluster_membership[rows, possible.indices]).ravel()
+        t = possible.data[members] - 1
         print
         
         print "Trans: count"
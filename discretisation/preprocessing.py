@@ -5,9 +5,10 @@ import sys
 
 import numpy as np
 import scipy.io as sio
-import scipy.sparse as sp
 
-from models import DiscreteInfo, PeakData, Feature, DatabaseEntry, Transformation
+from file_binner import make_precursor_bin, match_bins
+from models import PeakData, Feature, DatabaseEntry, Transformation
+from mulsubs.transformation import TransformationTable
 import utils
 
 class Discretiser(object):
@@ -20,9 +21,7 @@ class Discretiser(object):
         self.across_file_mass_tol = across_file_mass_tol
 
         self.adduct_name = np.array([t.name for t in self.transformations])[:,None]      # A x 1
-        self.adduct_mul = np.array([t.mul for t in self.transformations])[:,None]        # A x 1
-        self.adduct_sub = np.array([t.sub for t in self.transformations])[:,None]        # A x 1
-        self.adduct_del = np.array([t.iso for t in self.transformations])[:,None]        # A x 1
+        self.transformation_table = TransformationTable(self.transformations)
 
         # find index of M+H adduct in the list of transformations
         self.proton_pos = np.flatnonzero(np.array(self.adduct_name)=='M+H') 
@@ -37,41 +36,27 @@ class Discretiser(object):
         feature_masses = np.array([f.mass for f in features])[:, None]              # N x 1
         prior_rts = np.array([f.rt for f in features])[:, None]                     # K x 1
         prior_intensities = np.array([f.intensity for f in features])[:, None]      # K x 1
-        prior_masses = (feature_masses - self.adduct_sub[self.proton_pos])/self.adduct_mul[self.proton_pos] # K x 1
-        matRT = sp.lil_matrix((N, K), dtype=np.float)                                   # N x K, RTs of feature n in bin k
-        possible = sp.lil_matrix((N, K), dtype=np.int)                                  # N x K, transformation id+1 of feature n in bin k
-        transformed = sp.lil_matrix((N, K), dtype=np.float)                             # N x K, transformed masses of feature n in bin k
+
+        # the precursor mass of every feature under every transformation, the bins being 
+        # made from the M+H ones
+        prior_mass = self.transformation_table.transform(feature_masses)                     # N x T
+        prior_masses = prior_mass[:, self.proton_pos]                                        # K x 1
         bins = []
-        
-        # populate possible, transformed, matRT
         for n in range(N):
-            
-            if n%100 == 0:
-                sys.stdout.write('.')
-
-            current_mass, current_rt, current_intensity = feature_masses[n], prior_rts[n], prior_intensities[n]
-            pc_bin = self._make_precursor_bin(n, prior_masses[n], current_rt, current_intensity, self.within_file_mass_tol, self.within_file_rt_tol)
+            pc_bin = make_precursor_bin(n, prior_masses[n], prior_rts[n], prior_intensities[n], self.within_file_mass_tol, self.within_file_rt_tol)
             bins.append(pc_bin)
-            
-            prior_mass = (current_mass - self.adduct_sub)/self.adduct_mul + self.adduct_del
-            rt_ok = utils.rt_match(current_rt, prior_rts, self.within_file_rt_tol)
-            intensity_ok = (current_intensity <= prior_intensities)
-            for t in np.arange(len(self.transformations)):
-                mass_ok = utils.mass_match(prior_mass[t], prior_masses, self.within_file_mass_tol)
-                check = rt_ok*mass_ok*intensity_ok
-                # check = rt_ok*mass_ok                
-                pos = np.flatnonzero(check)
-                possible[n, pos] = t+1
-                transformed[n, pos] = prior_mass[t]
-                matRT[n, pos] = current_rt            
+
+        # populate possible, transformed, matRT
+        binning = match_bins(prior_mass, prior_rts[:, 0], prior_intensities[:, 0], 
+                             bins, prior_masses, prior_rts, prior_intensities,
+                             self.within_file_mass_tol, self.within_file_rt_tol)
 
         print "Total bins=" + str(K) + " total features=" + str(N)
-        binning = DiscreteInfo(possible, transformed, matRT, bins, prior_masses, prior_rts)
         return binning         
         
     def _find_features(self, bb, features):
         masses = np.array([f.mass for f in features])
-        precursor_masses = (masses - self.adduct_sub[self.proton_pos])/self.adduct_mul[self.proton_pos]
+        precursor_masses = self.transformation_table.transform(masses)[:, self.proton_pos]
         check1 = bb.get_begin() < precursor_masses
         check2 = precursor_masses < bb.get_end()
         pos = np.flatnonzero(check1*check2)
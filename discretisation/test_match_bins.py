@@ -0,0 +1,61 @@
+import numpy as np
+
+import utils
+from file_binner import match_bins
+from models import PrecursorBin
+
+def brute_force_match(transformed_masses, rts, intensities, prior_masses, prior_rts, prior_intensities,
+                      mass_tol, rt_tol):
+    ''' The possible, transformed and matRT matrices of match_bins as dense N x K arrays, checking
+        every feature against every bin under every transformation, the last match being kept '''
+    N, T = transformed_masses.shape
+    K = len(prior_masses)
+    possible = np.zeros((N, K), dtype=int)
+    transformed = np.zeros((N, K))
+    matRT = np.zeros((N, K))
+    for n in range(N):
+        for k in range(K):
+            for t in range(T):
+                if utils.mass_match(transformed_masses[n, t], prior_masses[k, 0], mass_tol) and \
+                        utils.rt_match(rts[n], prior_rts[k, 0], rt_tol) and \
+                        intensities[n] <= prior_intensities[k, 0]:
+                    possible[n, k] = t+1
+                    transformed[n, k] = transformed_masses[n, t]
+                    matRT[n, k] = rts[n]
+    return possible, transformed, matRT
+
+def main():
+
+    rng = np.random.RandomState(0)
+    N, K, T = 300, 200, 5
+    mass_tol, rt_tol = 10, 20
+
+    # bins spread over a narrow mass range so that many features fall into several of them
+    prior_masses = rng.uniform(100, 110, K)[:, None]
+    prior_rts = rng.uniform(0, 200, K)[:, None]
+    prior_intensities = rng.uniform(0, 100, K)[:, None]
+    bins = [PrecursorBin(k, prior_masses[k, 0], prior_rts[k, 0], prior_intensities[k, 0], mass_tol, rt_tol)
+            for k in range(K)]
+
+    # feature masses close to a bin mass under some of the transformations
+    transformed_masses = rng.uniform(100, 110, (N, T))
+    near = rng.rand(N, T) < 0.5
+    transformed_masses[near] = prior_masses[rng.randint(0, K, near.sum()), 0] * \
+                               (1 + 1e-6*mass_tol*rng.uniform(-1.2, 1.2, near.sum()))
+    rts = rng.uniform(0, 200, N)
+    intensities = rng.uniform(0, 100, N)
+
+    binning = match_bins(transformed_masses, rts, intensities, bins, prior_masses, prior_rts,
+                         prior_intensities, mass_tol, rt_tol)
+    possible, transformed, matRT = brute_force_match(transformed_masses, rts, intensities, prior_masses,
+                                                     prior_rts, prior_intensities, mass_tol, rt_tol)
+
+    print binning
+    print "possible matches: " + str((binning.possible.toarray() == possible).all())
+    print "transformed matches: " + str((binning.transformed.toarray() == transformed).all())
+    print "matRT matches: " + str(np.allclose(binning.matRT.toarray(), matRT))
+    assert (binning.possible.toarray() == possible).all()
+    assert (binning.transformed.toarray() == transformed).all()
+    assert np.allclose(binning.matRT.toarray(), matRT)
+
+if __name__ == "__main__": main()
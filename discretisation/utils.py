@@ -41,6 +41,50 @@ def timer(msg, start, end):
 def mass_match(mass, other_masses, tol):
     return np.abs((mass-other_masses)/mass)<tol*1e-6
 
+def mass_window_join(masses, other_masses, tol):
+    ''' Finds all the pairs (i, j) where mass_match(masses[i], other_masses[j], tol) holds.
+        other_masses is sorted once and the window of each mass searched in it, so this 
+        takes O((M + N) log N + P) for M masses, N other masses and P pairs found.
+        
+        Args:
+         - masses: the masses to match, flattened in C order
+         - other_masses: the masses to match them against, flattened in C order
+         - tol: the tolerance in ppm of the masses
+
+        Returns:
+         the index arrays i and j of the pairs, sorted by i then by increasing other mass
+    '''
+    masses = np.asarray(masses, dtype=float).ravel()
+    other_masses = np.asarray(other_masses, dtype=float).ravel()
+    order = np.argsort(other_masses, kind='mergesort')
+    sorted_masses = other_masses[order]
+
+    # the windows are slightly wider than in mass_match(), which then decides exactly
+    interval = np.abs(masses) * tol * 1e-6 * (1 + 1e-6)
+    starts = np.searchsorted(sorted_masses, masses - interval, side='left')
+    ends = np.searchsorted(sorted_masses, masses + interval, side='right')
+    counts = ends - starts
+    i = np.repeat(np.arange(len(masses)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    j = order[np.repeat(starts, counts) + offsets]
+
+    keep = mass_match(masses[i], other_masses[j], tol)
+    return i[keep], j[keep]
+
+def get_row(matrix, n):
+    ''' Returns the slice of the entries of row n in the indices and data of matrix, a CSR 
+        matrix or a DiscreteInfo '''
+    return slice(matrix.indptr[n], matrix.indptr[n+1])
+
+def get_possible_clusters(matrix, n):
+    ''' Returns a view of the columns of the entries of row n of matrix, a CSR matrix or a 
+        DiscreteInfo, e.g. the bins that feature n may go into '''
+    return matrix.indices[matrix.indptr[n]:matrix.indptr[n+1]]
+
+def get_row_sizes(matrix):
+    ''' Returns the number of entries of every row of matrix, a CSR matrix or a DiscreteInfo '''
+    return np.diff(matrix.indptr)
+
 def rt_match(rt, other_rts, tol):
     return np.abs(rt-other_rts)<tol
 
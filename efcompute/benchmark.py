@@ -0,0 +1,162 @@
+import sys
+import time
+import resource
+import multiprocessing
+
+import numpy as np
+
+from ef_assigner import ef_assigner
+from element_alphabet import element_alphabet
+from golden_rules import golden_rules
+from ef_constants import ELEMENT_MASSES
+
+BENCHMARK_ATOMS = ['H', 'C', 'N', 'O', 'P', 'S']
+MASS_RANGES = [(50, 300), (300, 600), (600, 1000), (1000, 1500)]
+SCALE_FACTORS = [100, 1000, 10000]
+STAGES = ['enumeration', 'rules', 'top hit']
+
+def make_formulas(n_per_range, seed, atoms=BENCHMARK_ATOMS, mass_ranges=MASS_RANGES):
+    '''
+    Draws random formulas that pass the golden rules, n_per_range of them in each mass range.
+    The same seed always gives the same formulas. Returns the (n, len(atoms)) count matrix
+    and the masses, sorted by mass range.
+    '''
+
+    rng = np.random.RandomState(seed)
+    gr = golden_rules()
+    atom_masses = np.array([ELEMENT_MASSES[a] for a in atoms])
+    columns = dict((a, i) for i, a in enumerate(atoms))
+
+    # random integers from 0 to each of the upper bounds, excluded
+    def uniform(upper):
+        return (rng.random_sample(len(upper))*upper).astype(np.int32)
+
+    found = [[] for r in mass_ranges]
+    while min(len(f) for f in found) < n_per_range:
+        size = 10000
+        counts = np.zeros((size, len(atoms)), dtype=np.int32)
+        c = rng.randint(1, 110, size)
+        counts[:, columns['C']] = c
+        counts[:, columns['H']] = uniform(2*c + 4)
+        counts[:, columns['N']] = uniform(np.minimum(c, 10) + 1)
+        counts[:, columns['O']] = uniform(np.minimum(c + 2, 20) + 1)
+        counts[:, columns['P']] = rng.randint(0, 3, size)
+        counts[:, columns['S']] = rng.randint(0, 3, size)
+        passed, breakdown = gr.filter_matrix(counts, atoms)
+        counts = counts[passed]
+        masses = counts.dot(atom_masses)
+        for i, (lower, upper) in enumerate(mass_ranges):
+            in_range = counts[(masses >= lower) & (masses < upper)]
+            found[i].extend(in_range[:n_per_range - len(found[i])])
+
+    counts = np.array([row for f in found for row in f])
+    return counts, counts.dot(atom_masses)
+
+def add_noise(masses, ppm, seed):
+    ''' Returns the masses shifted by a uniform random error of up to ppm '''
+    rng = np.random.RandomState(seed)
+    return masses*(1 + 1e-6*ppm*rng.uniform(-1, 1, len(masses)))
+
+def run_scale_factor(scale_factor, counts, masses, ppm, **kwargs):
+    '''
+    Assigns formulas to all the masses with one scale factor, timing every stage of find_formulas
+    separately. Returns the round-robin build time and, for every mass, its stage times, number
+    of candidates before and after the golden rules and whether the top hit is the right formula.
+    '''
+
+    # a new alphabet, so that its tables are built here and not shared with a previous run.
+    # The assigner then takes the round-robin table built here from the alphabet.
+    alphabet = element_alphabet.from_names(BENCHMARK_ATOMS)
+    start = time.time()
+    alphabet.get_round_robin(scale_factor, kwargs.get('rr_cache_dir'))
+    build_time = time.time() - start
+    ea = ef_assigner(scale_factor=scale_factor, verbose=False, alphabet=alphabet, **kwargs)
+
+    results = []
+    for true_counts, mass in zip(counts, masses):
+        times = []
+
+        start = time.time()
+        candidates, candidate_masses = ea._find_candidates(mass, ppm)
+        times.append(time.time() - start)
+
+        start = time.time()
+        passed = ea._filter_rules(candidates)
+        candidates = candidates[passed]
+        times.append(time.time() - start)
+
+        start = time.time()
+        correct = False
+        formulas = ea._to_dicts(ea._adjust_hydrogen(candidates, "none"))
+        if len(candidates) > 0:
+            best = ea._get_closest(candidates, mass)
+            ea._get_formula_string(formulas[best])
+            correct = (candidates[best] == true_counts).all()
+        times.append(time.time() - start)
+
+        results.append((times, int(passed.size), len(candidates), correct))
+    return build_time, results
+
+def get_peak_memory():
+    ''' The peak resident memory of this process so far, in MB '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def measure_scale_factor(scale_factor, counts, masses, ppm, kwargs):
+    ''' run_scale_factor, also returning the peak memory of the process it ran in '''
+    build_time, results = run_scale_factor(scale_factor, counts, masses, ppm, **kwargs)
+    return build_time, results, get_peak_memory()
+
+def run_isolated(scale_factor, counts, masses, ppm, **kwargs):
+    '''
+    measure_scale_factor in a new process, since the peak memory of a process never goes down
+    and would otherwise include that of the scale factors run before
+    '''
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(measure_scale_factor, (scale_factor, counts, masses, ppm, kwargs))
+    finally:
+        pool.close()
+        pool.join()
+
+def print_report(scale_factor, build_time, peak_memory, results, masses, mass_ranges=MASS_RANGES):
+
+    print "scale factor %d: round-robin build %.4fs, peak memory %.1f MB" % (scale_factor, build_time,
+                                                                            peak_memory)
+    print "  %-12s %8s %10s %12s %12s %9s" % ('mass range', 'masses/s', 'candidates', 'after rules',
+                                               'top hit ok', 'time')
+    for lower, upper in mass_ranges:
+        selected = [r for r, m in zip(results, masses) if lower <= m < upper]
+        if not selected:
+            continue
+        stage_times = np.array([r[0] for r in selected]).sum(axis=0)
+        total = stage_times.sum()
+        print "  %-12s %8.1f %10.1f %12.1f %11.0f%% %8.2fs" % ("%d-%d" % (lower, upper),
+              len(selected) / total if total > 0 else float('inf'),
+              np.mean([r[1] for r in selected]), np.mean([r[2] for r in selected]),
+              100.0*np.mean([r[3] for r in selected]), total)
+        print "  %-12s %s" % ('', ', '.join("%s %.0f%%" % (stage, 100.0*t/total if total > 0 else 0)
+                                            for stage, t in zip(STAGES, stage_times)))
+    sys.stdout.flush()
+
+if __name__=='__main__':
+
+    if len(sys.argv) > 1 and sys.argv[1] in ('-h', '--help'):
+        print "Usage: python benchmark.py [masses per mass range = 2] [ppm = 5] [seed = 0] " + \
+              "[scale factors = 100,1000,10000] [track_rounding_error = 0]"
+        sys.exit(0)
+    n_per_range = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    ppm = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    scale_factors = SCALE_FACTORS
+    if len(sys.argv) > 4:
+        scale_factors = [int(s) for s in sys.argv[4].split(',')]
+    track_rounding_error = len(sys.argv) > 5 and sys.argv[5] == '1'
+
+    # the measured masses are off by up to half the tolerance
+    counts, masses = make_formulas(n_per_range, seed)
+    masses = add_noise(masses, ppm/2, seed)
+    print "%d formulas from %.1f to %.1f Da, %.1f ppm, seed %d" % (len(masses), masses.min(), masses.max(), ppm, seed)
+    for scale_factor in scale_factors:
+        build_time, results, peak_memory = run_isolated(scale_factor, counts, masses, ppm,
+                                                        track_rounding_error=track_rounding_error)
+        print_report(scale_factor, build_time, peak_memory, results, masses)
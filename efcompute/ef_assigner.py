@@ -1,18 +1,89 @@
-import sys
+import time
 import fractions
-from math import ceil, floor
+import heapq
+import multiprocessing
+from collections import OrderedDict
+from math import ceil
+
+import numpy as np
+
 from golden_rules import golden_rules
-from ef_constants import INFINITE, ATOM_NAME_LIST, ATOM_MASSES, PROTON_MASS, DEFAULT_RULES_SWITCH
+from ppm_profile import ppm_profile
+from isotope_scorer import isotope_scorer
+from element_alphabet import DEFAULT_ALPHABET
+from instrumentation import search_counters, verbose_printer
+from formula_results import formula_results, get_candidate_dtype, get_rule_mask, QUERY_DTYPE
+from ef_constants import INFINITE, PROTON_MASS, DEFAULT_RULES_SWITCH, \
+    DECOMPOSITION_BATCH_SIZE, RESULT_CACHE_MASS_DECIMALS, ADDUCTS, DEFAULT_ADDUCTS
+
+# the assigner used by the worker processes of ef_assigner.find_formulas. It is set by the
+# pool initializer, so with fork the tables are inherited instead of pickled for every task.
+_worker_assigner = None
+
+def _init_worker(assigner):
+    global _worker_assigner
+    _worker_assigner = assigner
+    # the result cache is read and filled by the parent, a worker's copy would be lost
+    _worker_assigner.result_cache = None
+
+def _search_worker(args):
+    queries, polarisation, batch_mode = args
+    return _worker_assigner._search(queries, polarisation, batch_mode)
+
+class result_cache(object):
+    ''' A bounded cache of find_formulas results that drops the least recently used entry 
+        when it is full, and counts its hits and misses '''
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        value = self.entries.pop(key)
+        self.entries[key] = value # move to the most recently used end
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return "result_cache size=%d/%d hits=%d misses=%d" % (len(self.entries), self.max_size, 
+                                                              self.hits, self.misses)
 
 class ef_assigner(object):
     
     def __init__(self, scale_factor=1000, enforce_ppm=True, do_7_rules=True, 
                  second_stage=False, rule_8_max_occurrences=None,
-                 verbose = True):
+                 verbose = True, rr_cache_dir=None, formula_index=None, result_cache_size=0,
+                 track_rounding_error=False, alphabet=None, instrumentation=None):
 
+        # the elements to search, by default those of ATOM_NAME_LIST without C13, F and Cl 
+        # unless second_stage is on. C13, F and Cl are only removed from the default alphabet, 
+        # a given alphabet is searched as it is apart from the rule 8 removals below.
         self.verbose = verbose
-        self.atoms = list(ATOM_NAME_LIST) # copy
-        self.atom_masses = dict(ATOM_MASSES)
+        default_alphabet = alphabet is None
+        if default_alphabet:
+            alphabet = DEFAULT_ALPHABET
 
         self.do_7_rules = do_7_rules
         if self.do_7_rules:
@@ -24,28 +95,43 @@ class ef_assigner(object):
                 rule_switch[7] = False
             else:
                 rule_switch[7] = True                
+                to_remove = []
                 for key in rule_8_max_occurrences:
                     value = rule_8_max_occurrences[key]
-                    if value == 0 and key in self.atoms:
+                    if value == 0 and key in alphabet.names:
                         print key + " removed from the list of atoms to search"
-                        self.atoms.remove(key)
-                        del self.atom_masses[key]                        
+                        to_remove.append(key)
+                alphabet = alphabet.without(to_remove)
 
             # if second stage clustering, then also include C13, F and Cl
             # otherwise remove them from the list of atoms to be considered
-            if not second_stage:
-                to_remove = ('C13', 'F', 'Cl')
-                for a_name in to_remove:
-                    if a_name in self.atoms:
-                        self.atoms.remove(a_name)
-                        del self.atom_masses[a_name]
-
-            self.gr = golden_rules(rule_switch, rule_8_max_occurrences)
+            if not second_stage and default_alphabet:
+                alphabet = alphabet.without(('C13', 'F', 'Cl'))
+
+            self.gr = golden_rules(rule_switch, rule_8_max_occurrences, alphabet)
+            self.rules_key = (tuple(rule_switch), tuple(sorted((rule_8_max_occurrences or {}).items())))
+        else:
+            self.rules_key = None
+
+        self.alphabet = alphabet
+        self.atoms = list(alphabet.names) # copy
+        self.atom_masses = dict(alphabet.masses)
+
+        # masses covered by a pre-built formula_index are looked up there instead of being 
+        # decomposed. The index only holds formulas within the ppm window, so enforce_ppm must be on.
+        self.formula_index = formula_index
+        if formula_index is not None:
+            self._check_formula_index(formula_index, rule_8_max_occurrences, enforce_ppm)
         
         print "Atoms being considered = " + str(self.atoms)
         self.scale_factor = scale_factor
-        self.a = self._get_dictionary()
-        self.rr = self._round_robin()
+        self.a = alphabet.get_dictionary(scale_factor)
+        self.atom_mass_vector = np.array([self.atom_masses[a] for a in self.atoms])
+        self.rr = alphabet.get_round_robin(scale_factor, rr_cache_dir)
+        # the enumeration in _find_all does many single-element lookups, which are 
+        # much faster on python lists than on numpy scalars
+        self.rr_rows = alphabet.get_round_robin_rows(scale_factor)
+        self.lcm = [self.a[0]*ai / fractions.gcd(self.a[0], ai) for ai in self.a]
         self.enforce_ppm = enforce_ppm
         
         # Compute correction factor for upper bound
@@ -56,32 +142,285 @@ class ef_assigner(object):
                 self.delta = delta_i
         # print self.delta
 
-    def find_formulas(self, mass_list, ppm=5, polarisation="None", max_mass_to_check=INFINITE):
-        
+        # with enforce_ppm, the enumeration can track the rounding error of the ceil-scaled 
+        # atom masses along each branch and drop the ones that can't reach the ppm window, 
+        # instead of generating all the decompositions and filtering them afterwards
+        self.track_rounding_error = track_rounding_error and enforce_ppm
+        self.rounding_errors = [ai - scale_factor*self.atom_masses[name] for ai, name in zip(self.a, self.atoms)]
+        error_rates = [e / ai for e, ai in zip(self.rounding_errors, self.a)]
+        self.min_error_rates = [min(error_rates[:i+1]) for i in range(len(error_rates))]
+        self.max_error_rates = [max(error_rates[:i+1]) for i in range(len(error_rates))]
+
+        self.isotope_scorer = isotope_scorer()
+
+        # instrumentation is called with the search_counters of every mass searched by 
+        # find_formulas. verbose prints them unless another callback is given.
+        if instrumentation is None and verbose:
+            instrumentation = verbose_printer()
+        self.instrumentation = instrumentation
+        self.nodes_visited = 0 # incremented by the enumeration
+
+        # the results of the last result_cache_size queries, keyed by their quantised neutral mass,
+        # so masses seen again (e.g. in the other files of a batch) are not searched again
+        self.result_cache = None
+        if result_cache_size > 0:
+            self.result_cache = result_cache(result_cache_size)
+
+    def find_formulas(self, mass_list, ppm=5, polarisation="None", max_mass_to_check=INFINITE,
+                      batch_mode=False, n_processes=1, isotope_intensities=None):
+        ''' Finds the candidate formulas of the masses in mass_list. If batch_mode is True, 
+            the integer masses shared by the search windows of several masses are decomposed 
+            only once, which is faster on dense peak lists but gives the same results. 
+            If n_processes > 1, the masses that are not in the result cache are split across 
+            a pool of worker processes. 
+            ppm is either one tolerance for all masses, a ppm_profile, or a list of 
+            (mass, ppm) pairs used as a step ppm_profile. 
+            If isotope_intensities is given, it has the observed (M+0, M+1, M+2) intensities, 
+            or None, of every mass in mass_list, and the top hit of these masses is then the 
+            candidate whose isotope envelope matches them best, the closest in mass first. '''
+
         polarisation = polarisation.lower()
-        
-        # used to accumulate values during the recursive calls in _find_all
-        # TODO: better if we can get rid of the global keyword
-        global formulas
+        precursor_mass_list, queries = self._get_queries(mass_list, ppm, polarisation, max_mass_to_check)
+
+        formulas_out = {}
+        top_hit_string = [None for query in queries]
+
+        def finished(q, result, stat):
+            precursor_mass, conditional_ppm = queries[q]
+            counts, n_candidates = result
+
+            # the output formulas are only turned into dictionaries here
+            formulas_out[precursor_mass] = self._to_dicts(counts)
+
+            # If there is no top hit string, then leave it as None, else find the formula 
+            # closest in mass to the theoretical mass, or the one with the best isotope 
+            # envelope if the observed intensities are known
+            if len(counts) > 0:
+                if isotope_intensities is not None and isotope_intensities[q] is not None:
+                    best = self._get_best_isotope_match(counts, precursor_mass, isotope_intensities[q])
+                else:
+                    best = self._get_closest(counts, precursor_mass)
+                top_hit_string[q] = self._get_formula_string(formulas_out[precursor_mass][best])
+
+            # report the progress as each mass is done, not once they all are
+            if self.instrumentation is not None:
+                self.instrumentation(search_counters(q, len(queries), precursor_mass, conditional_ppm, 
+                                                     *(stat + (top_hit_string[q],))))
 
-        # check for conditional mass tolerance
-        if type(ppm) is list:
-            cond_mass_tol = True
+        if n_processes > 1:
+            self._search_parallel(queries, polarisation, batch_mode, n_processes, finished)
         else:
-            cond_mass_tol = False
-        
+            self._search(queries, polarisation, batch_mode, finished)
+
+        return formulas_out, top_hit_string, precursor_mass_list
+    
+    def find_formula_results(self, mass_list, ppm=5, polarisation="None", max_mass_to_check=INFINITE,
+                             batch_mode=False):
+        ''' Finds the candidate formulas of the masses in mass_list like find_formulas, and returns 
+            them as a formula_results, keyed by the position of the masses in mass_list. The 
+            formulas are the neutral ones, and those failing the golden rules are kept with 
+            the rules they failed. The search is therefore not pruned by the rule 1 and 8 limits, 
+            and the formula index, which only holds formulas passing the rules, is not used. '''
+
+        polarisation = polarisation.lower()
+        precursor_mass_list, queries = self._get_queries(mass_list, ppm, polarisation, max_mass_to_check)
+        if batch_mode:
+            batch_formulas = self._find_candidates_batch(queries, prune_rules=False)
+
+        query_table = np.zeros(len(queries), dtype=QUERY_DTYPE)
+        query_table['mass'] = mass_list
+        query_table['precursor_mass'] = np.nan
+        tables = []
+        for q, query in enumerate(queries):
+            if query is None:
+                continue
+            precursor_mass, conditional_ppm = query
+            query_table[q]['precursor_mass'] = precursor_mass
+            query_table[q]['ppm'] = conditional_ppm
+
+            if batch_mode:
+                counts, masses = batch_formulas[q]
+                batch_formulas[q] = None
+            else:
+                counts, masses = self._find_candidates(precursor_mass, conditional_ppm, prune_rules=False)
+
+            table = np.zeros(len(counts), dtype=get_candidate_dtype(self.atoms))
+            table['query'] = q
+            for i, a in enumerate(self.atoms):
+                table[a] = counts[:, i]
+            table['mass'] = masses
+            table['ppm_error'] = 1e6*(masses - precursor_mass)/precursor_mass
+            if self.do_7_rules:
+                passed, breakdown = self.gr.filter_matrix(counts, self.atoms, diagnostic=True)
+                table['rules'] = get_rule_mask(self.gr.rule_switch, breakdown)
+            else:
+                table['rules'] = get_rule_mask([False]*8, np.ones((len(counts), 0), dtype=bool))
+            tables.append(table)
+
+        if tables:
+            candidates = np.concatenate(tables)
+        else:
+            candidates = np.zeros(0, dtype=get_candidate_dtype(self.atoms))
+        return formula_results(query_table, candidates)
+
+    def find_formulas_adducts(self, mass_list, adducts=DEFAULT_ADDUCTS, ppm=5, max_mass_to_check=INFINITE):
+        ''' Finds the candidate formulas of every mass in mass_list under every adduct hypothesis 
+            in adducts, named as in ADDUCTS. The neutral masses of all the (feature, adduct) pairs 
+            are searched together in batch mode, so the integer masses shared by their windows 
+            are decomposed once. Returns the neutral formulas, the top hit string and the neutral 
+            mass of every pair, in dictionaries keyed by (index in mass_list, adduct name). '''
+
+        pairs = []
+        neutral_mass_list = []
+        for f, mass in enumerate(mass_list):
+            for name in adducts:
+                shift, factor = ADDUCTS[name]
+                neutral_mass = (mass - shift)/factor
+                pairs.append((f, name))
+                neutral_mass_list.append(neutral_mass if neutral_mass > 0 else None)
+
+        neutral_mass_list, queries = self._get_queries(neutral_mass_list, ppm, "none", max_mass_to_check)
+        results, stats = self._search(queries, "none", batch_mode=True)
+
         formulas_out = {}
-        top_hit_string = []
-        n = 0
-        total = len(mass_list)
-        precursor_mass_list = []
-        for mass in mass_list:
+        top_hit_string = {}
+        neutral_masses = {}
+        for pair, query, result in zip(pairs, queries, results):
+            neutral_masses[pair] = query[0] if query is not None else None
+            top_hit_string[pair] = None
+            if query is None:
+                continue
+            counts, n_candidates = result
+            formulas_out[pair] = self._to_dicts(counts)
+            if len(counts) > 0:
+                best = self._get_closest(counts, query[0])
+                top_hit_string[pair] = self._get_formula_string(formulas_out[pair][best])
+        return formulas_out, top_hit_string, neutral_masses
+
+    def _search(self, queries, polarisation, batch_mode, finished=None):
+        ''' Returns the (count matrix, number of candidates before the golden rules) of the formulas 
+            found for every (precursor_mass, ppm) query, or None for the queries that are None. 
+            The count matrices are adjusted for the polarisation. Also returns the (integer masses, 
+            nodes, candidates, candidates after the rules, elapsed ns) counters of every query, 
+            or None for all of them when there is no instrumentation to report them to. 
+            If finished is given, it is called with the index, result and counters of every 
+            query as soon as it is done. '''
+
+        # the cached results are all read before searching, since the results put in the 
+        # cache below can evict the entries of the later queries
+        cache_keys = [self._get_cache_key(query, polarisation) for query in queries]
+        cached_results = [self.result_cache.get(key) if key is not None else None for key in cache_keys]
+        timed = self.instrumentation is not None
+        work = None
+        if timed:
+            work = dict((q, [0, 0, 0.0]) for q, query in enumerate(queries) if query is not None)
+        if batch_mode:
+            to_search = []
+            for query, cached in zip(queries, cached_results):
+                if query is None or self._is_indexed(*query) or cached is not None:
+                    to_search.append(None)
+                else:
+                    to_search.append(query)
+            batch_formulas = self._find_candidates_batch(to_search, work)
+
+        results = []
+        stats = []
+        for q, query in enumerate(queries):
+            if query is None:
+                results.append(None)
+                stats.append(None)
+                continue
+            precursor_mass, conditional_ppm = query
+            if timed:
+                start = time.time()
+                nodes_visited = self.nodes_visited
+
+            cached = cached_results[q]
+            if cached is not None:
+                results.append(cached)
+                if timed:
+                    stats.append((0, 0, cached[1], len(cached[0]), int((time.time() - start)*1e9)))
+                else:
+                    stats.append(None)
+                if finished is not None:
+                    finished(q, results[q], stats[q])
+                continue
+
+            # find all the candidate formulae, as an (n_candidates, n_atoms) count matrix
+            # and the vector of their masses
+            if self._is_indexed(precursor_mass, conditional_ppm):
+                counts, masses = self._find_candidates_indexed(precursor_mass, conditional_ppm)
+            elif batch_mode:
+                counts, masses = batch_formulas[q]
+                batch_formulas[q] = None
+            else:
+                counts, masses = self._find_candidates(precursor_mass, conditional_ppm)
+                if timed:
+                    int_lower_bound, int_upper_bound = self._get_integer_bounds(precursor_mass, conditional_ppm)
+                    work[q][0] += int_upper_bound - int_lower_bound + 1
+            n_candidates = len(counts)
+
+            # check with 7 golden rules
+            if self.do_7_rules:
+                passed = self._filter_rules(counts)
+                counts, masses = counts[passed], masses[passed]
             
-            n += 1
-            k = len(self.rr)
-            c = [0 for i in range(0, k)]
+            # adjust the amount of hydrogen to print the charged formula -- based on polarity
+            counts = self._adjust_hydrogen(counts, polarisation)
+            if cache_keys[q] is not None:
+                self.result_cache.put(cache_keys[q], (counts, n_candidates))
+            results.append((counts, n_candidates))
+
+            if timed:
+                int_masses, nodes, seconds = work[q]
+                nodes += self.nodes_visited - nodes_visited
+                seconds += time.time() - start
+                stats.append((int_masses, nodes, n_candidates, len(counts), int(seconds*1e9)))
+            else:
+                stats.append(None)
+            if finished is not None:
+                finished(q, results[q], stats[q])
+        return results, stats
+
+    def iter_formulas(self, mass_list, ppm=5, polarisation="None", max_mass_to_check=INFINITE, top_k=None):
+        ''' Yields (precursor_mass, formula) pairs for the masses in mass_list, as the formulas 
+            passing the ppm check and the golden rules are found, without keeping them all. 
+            If top_k is set, only the top_k formulas closest in mass to each precursor mass 
+            are yielded, closest first. The integer masses are then decomposed in order of how 
+            close their formulas can get to the precursor, and the search stops when none of 
+            the remaining ones can beat the worst formula kept. '''
 
-            formulas = []
+        if top_k is not None and top_k < 1:
+            raise ValueError("top_k must be at least 1, not " + str(top_k))
+        polarisation = polarisation.lower()
+        precursor_mass_list, queries = self._get_queries(mass_list, ppm, polarisation, max_mass_to_check)
+        for query in queries:
+            if query is None:
+                continue
+            precursor_mass, conditional_ppm = query
+            if top_k is None:
+                batches = self._iter_candidates(precursor_mass, conditional_ppm)
+            else:
+                batches = [self._find_top_candidates(precursor_mass, conditional_ppm, top_k)]
+            for counts, masses in batches:
+                counts = self._adjust_hydrogen(counts, polarisation)
+                for formula in self._to_dicts(counts):
+                    yield precursor_mass, formula
+
+    def _get_queries(self, mass_list, ppm, polarisation, max_mass_to_check):
+        ''' Returns the list of precursor masses and the list of (precursor_mass, ppm) queries to 
+            search for the masses in mass_list, with None for the masses that are not searched '''
+
+        # check for conditional mass tolerance, the (mass, ppm) lists are step profiles
+        if isinstance(ppm, ppm_profile):
+            profile = ppm
+        elif type(ppm) is list:
+            profile = ppm_profile.from_list(ppm)
+        else:
+            profile = None
+
+        precursor_mass_list = []
+        for mass in mass_list:
 
             # compute the right precursor mass, given the polarisation
             if polarisation == "pos":
@@ -92,182 +431,512 @@ class ef_assigner(object):
                 precursor_mass = mass
             precursor_mass_list.append(precursor_mass)
 
-            # get the mass tolerance
-            if cond_mass_tol:
-                conditional_ppm = self._get_conditional_ppm(precursor_mass, ppm)
-            else:
-                conditional_ppm = ppm # unchanged, this should be a float
+        # always return None for all precursor masses above max_ms1
+        searched = [p for p in precursor_mass_list if p is not None and p <= max_mass_to_check]
 
-            # always return None for all precursor masses above max_ms1
-            if  precursor_mass is None or precursor_mass > max_mass_to_check:
-                top_hit_string.append(None)
-                continue
+        # get the mass tolerances of all the searched masses at once
+        if profile is not None:
+            conditional_ppms = iter(profile.get_ppm(searched).tolist())
+        else:
+            conditional_ppms = iter([ppm]*len(searched)) # unchanged, this should be a float
 
-            # find all the candidate formulae                
-            ppm_error = conditional_ppm*precursor_mass/1e6
-            lower_bound = precursor_mass - ppm_error
-            upper_bound = precursor_mass + ppm_error
-            int_lower_bound = int(ceil(lower_bound*self.scale_factor))
-            int_upper_bound = int(floor(upper_bound*self.scale_factor + self.delta*upper_bound))
-            for int_mass in range(int_lower_bound, int_upper_bound+1):
-                self._find_all(int_mass, k-1, c, conditional_ppm, precursor_mass)
-
-            formulas_out[precursor_mass] = []
-            for f in formulas:
-                formula = {}
-                for i,a in enumerate(self.atoms):
-                    formula[a] = f[i]
-                formulas_out[precursor_mass].append(formula)
+        queries = []
+        for precursor_mass in precursor_mass_list:
+            if precursor_mass is None or precursor_mass > max_mass_to_check:
+                queries.append(None)
+            else:
+                queries.append((precursor_mass, next(conditional_ppms)))
+        return precursor_mass_list, queries
 
-            # check with 7 golden rules
+    def _iter_candidates(self, precursor_mass, ppm, int_masses=None):
+        ''' Yields the count matrices and masses of the candidate formulas of precursor_mass 
+            that pass the golden rules, batch by batch, decomposing int_masses in the given 
+            order or else the whole integer window of precursor_mass at ppm '''
+
+        if self._is_indexed(precursor_mass, ppm):
+            batches = [self._find_candidates_indexed(precursor_mass, ppm)]
+        else:
+            int_lower_bound, int_upper_bound = self._get_integer_bounds(precursor_mass, ppm)
+            if int_masses is None:
+                int_masses = range(int_lower_bound, int_upper_bound+1)
+            batches = self._iter_decompositions(int_masses, self._get_max_counts(int_lower_bound, int_upper_bound),
+                                                ppm, precursor_mass)
+        for counts, masses in batches:
             if self.do_7_rules:
-                filtered_formulas_out = {}
-                filtered_formulas_out[precursor_mass], passed, failed = self.gr.filter_list(formulas_out[precursor_mass])
-                formulas_out[precursor_mass] = filtered_formulas_out[precursor_mass]
-            
-            # adjust the amount of hydrogen to print the charged formula -- based on polarity
-            if polarisation == "pos":
-                for f in formulas_out[precursor_mass]:
-                    f['H'] += 1
-            elif polarisation == "neg":
-                for f in formulas_out[precursor_mass]:
-                    if f['H'] >= 1:
-                        f['H'] -= 1
+                passed = self._filter_rules(counts)
+                counts, masses = counts[passed], masses[passed]
+            if len(counts) > 0:
+                yield counts, masses
+
+    def _iter_decompositions(self, int_masses, max_counts, ppm, precursor_mass):
+        ''' Yields the decompositions of int_masses within ppm of precursor_mass, batch by batch '''
+
+        for int_mass in int_masses:
+            for batch in self._decompose(int_mass, max_counts, [(precursor_mass, ppm)]):
+                yield self._filter_ppm(batch, self._get_masses(batch), ppm, precursor_mass)
 
-            # If there is no top hit string, then just set None to the resulting list
-            if len(formulas_out[precursor_mass]) == 0:
-                top_hit_string.append(None)
+    def _find_top_candidates(self, precursor_mass, ppm, top_k):
+        ''' Returns the count matrix and masses of the top_k candidate formulas of precursor_mass
+            that pass the golden rules, sorted by their mass error '''
+
+        # a formula of mass M decomposes an integer mass between M*scale_factor and 
+        # M*(scale_factor + delta), so this is the smallest error of any formula found 
+        # by decomposing int_mass
+        def lowest_error(int_mass):
+            lightest = int_mass / (self.scale_factor + self.delta)
+            heaviest = int_mass / float(self.scale_factor)
+            return max(0, lightest - precursor_mass, precursor_mass - heaviest)
+
+        int_lower_bound, int_upper_bound = self._get_integer_bounds(precursor_mass, ppm)
+        int_masses = sorted(range(int_lower_bound, int_upper_bound+1), key=lowest_error)
+
+        # a heap of the (-error, -order, count vector, mass) of the formulas kept so far, the
+        # worst one on top. Among formulas with the same error, the ones found first are kept.
+        kept = []
+        order = 0
+        for counts, masses in self._iter_candidates(precursor_mass, ppm, self._iter_sorted(int_masses, 
+                                                    lowest_error, kept, top_k)):
+            errors = np.abs(masses - precursor_mass)
+            for row, mass, error in zip(counts, masses, errors):
+                item = (-error, -order, row, mass)
+                order += 1
+                if len(kept) < top_k:
+                    heapq.heappush(kept, item)
+                elif item > kept[0]:
+                    heapq.heapreplace(kept, item)
+
+        kept = sorted(kept, reverse=True)
+        counts = np.array([k[2] for k in kept], dtype=np.int32).reshape(len(kept), len(self.atoms))
+        masses = np.array([k[3] for k in kept])
+        return counts, masses
+
+    def _iter_sorted(self, int_masses, lowest_error, kept, top_k):
+        ''' Yields the sorted int_masses until none of the formulas they decompose to can get 
+            closer to the precursor than the worst of the top_k formulas kept '''
+
+        for int_mass in int_masses:
+            if len(kept) == top_k and lowest_error(int_mass) > -kept[0][0]:
+                return
+            yield int_mass
+
+    def _search_parallel(self, queries, polarisation, batch_mode, n_processes, finished=None):
+        ''' Like _search, but the queries that are not in the result cache are searched in a pool 
+            of n_processes worker processes, over contiguous shards so that in batch mode the 
+            neighbouring queries still share their integer masses. The result cache is only read 
+            and filled here, since the workers have their own copies of it. finished is called 
+            here as in _search, for the cached queries first and then as each shard comes back. '''
+
+        timed = self.instrumentation is not None
+        cache_keys = [self._get_cache_key(query, polarisation) for query in queries]
+        results = [None for query in queries]
+        stats = [None for query in queries]
+        missed = []
+        for q, query in enumerate(queries):
+            if query is None:
                 continue
+            cached = self.result_cache.get(cache_keys[q]) if cache_keys[q] is not None else None
+            if cached is None:
+                missed.append(q)
             else:
-                
-                # else find the formula closest in mass to the theoretical mass 
-                closest = None
-                for f in formulas_out[precursor_mass]:
-                    mass = 0.0
-                    f_string = ""
-                    for atom in f:
-                        
-                        mass += f[atom]*self.atom_masses[atom]
-
-                        # print C13 as [C13]
-                        atom_str = atom
-                        if atom_str == 'C13':
-                            atom_str = '[C13]'
-                        if f[atom]>1:
-                            f_string += "{}{}".format(atom_str, f[atom])
-                        elif f[atom] == 1:
-                            f_string += "{}".format(atom_str)
-                    
-                    er = abs(mass - precursor_mass)
-                    # print er, f_string
-                    if closest == None:
-                        best_er = er
-                        closest = f_string
-                    elif best_er > er:
-                        best_er = er
-                        closest = f_string                
-                top_hit_string.append(closest)
-
-                if self.verbose:
-                    if len(formulas) > 0:
-                        print "Searching for neutral mass %f (%d/%d) at tolerance %d ppm" % (precursor_mass, n, total, 
-                                                                                             conditional_ppm)                    
-                        if len(formulas_out[precursor_mass]) > 0:
-                            print "- found " + str(len(formulas)) + " candidate(s), best formula = " + closest
-                        else:
-                            print "- found " + str(len(formulas)) + " candidate(s), nothing after filtering"                        
-                        sys.stdout.flush()
+                results[q] = cached
+                if timed:
+                    stats[q] = (0, 0, cached[1], len(cached[0]), 0)
+                if finished is not None:
+                    finished(q, results[q], stats[q])
+        if not missed:
+            return results, stats
 
-        return formulas_out, top_hit_string, precursor_mass_list
-    
-    def _get_conditional_ppm(self, mass, ppm_list):
-        ''' Get the conditional annotation ppm for the specified mass '''
-
-        # assume ppm_list always contains 2 entries
-        first_item = ppm_list[0]
-        second_item = ppm_list[1]
-        lower_bound = first_item[0]
-        upper_bound = second_item[0]
-
-        # find the conditional tolerance to use for this mass
-        if mass > lower_bound and mass < upper_bound:
-            higher_tol = second_item[1]
-            return higher_tol
-        elif mass <= lower_bound:
-            lower_tol = first_item[1]
-            return lower_tol
-        elif mass >= upper_bound:
-            # use the higher tolerance anyway
-            higher_tol = second_item[1]
-            return higher_tol
-    
-    def _find_all(self, mass, i, c, ppm, precursor_mass):
+        # use a few shards per process to even out the load between the workers
+        shard_size = max(1, int(ceil(len(missed) / (4.0*n_processes))))
+        shards = [missed[start:start+shard_size] for start in range(0, len(missed), shard_size)]
+        pool = multiprocessing.Pool(n_processes, initializer=_init_worker, initargs=(self,))
+        try:
+            # imap returns the shards in order, each one as soon as it and those before it are done
+            searched = pool.imap(_search_worker, [([queries[q] for q in shard], polarisation, batch_mode) 
+                                                  for shard in shards])
+            for shard, (shard_results, shard_stats) in zip(shards, searched):
+                for q, result, stat in zip(shard, shard_results, shard_stats):
+                    results[q] = result
+                    stats[q] = stat
+                    if cache_keys[q] is not None:
+                        self.result_cache.put(cache_keys[q], result)
+                    if finished is not None:
+                        finished(q, result, stat)
+        finally:
+            pool.close()
+            pool.join()
+        return results, stats
+
+    def _get_cache_key(self, query, polarisation):
+        ''' Returns the result cache key of a (precursor_mass, ppm) query, or None if it is not cached '''
+
+        if self.result_cache is None or query is None:
+            return None
+        precursor_mass, ppm = query
+        quantised_mass = int(round(precursor_mass * 10**RESULT_CACHE_MASS_DECIMALS))
+        return (quantised_mass, ppm, polarisation, self.rules_key)
+
+    def _check_formula_index(self, index, rule_8_max_occurrences, enforce_ppm):
+        ''' Raises a ValueError if index can't give the same formulas as the search '''
+
+        missing = [a for a in self.atoms if a not in index.atoms]
+        if missing:
+            raise ValueError("Atoms " + str(missing) + " are not in " + str(index))
+        if not self.do_7_rules:
+            raise ValueError("A formula index can only be used when the golden rules are on")
+        if not enforce_ppm:
+            raise ValueError("A formula index can only be used when enforce_ppm is on")
+        if list(index.rule_switch) != list(self.gr.rule_switch) or \
+            index.rule_8_max_occurrences != rule_8_max_occurrences:
+            raise ValueError("The golden rules settings are different from those of " + str(index))
+
+    def _is_indexed(self, precursor_mass, ppm):
+        ''' True if the candidates of precursor_mass at ppm are all in the formula index '''
+
+        if self.formula_index is None:
+            return False
+        return precursor_mass + ppm*precursor_mass/1e6 <= self.formula_index.max_mass
+
+    def _find_candidates_indexed(self, precursor_mass, ppm):
+        ''' Returns the count matrix and masses of the candidate formulas of precursor_mass from 
+            the formula index. The lookup window is widened and then filtered with the same test 
+            as _filter_ppm, so that formulas at the edges of the window are treated the same. '''
+
+        ppm_error = ppm*precursor_mass/1e6
+        counts, masses = self.formula_index.find(precursor_mass - 2*ppm_error, precursor_mass + 2*ppm_error, 
+                                                 self.atoms)
+        within = np.abs(masses - precursor_mass)/precursor_mass <= 1e-6*ppm
+        within &= (counts <= np.array(self.alphabet.max_counts)).all(axis=1)
+        return counts[within], masses[within]
 
-        if i == 0:
-            c[0] = mass/self.a[0]
+    def _get_integer_bounds(self, precursor_mass, ppm):
+        ''' Returns the range of integer masses to decompose for precursor_mass at ppm, or 
+            the arrays of the bounds of all the ranges if given arrays of masses and ppms '''
+
+        ppm_error = ppm*precursor_mass/1e6
+        lower_bound = precursor_mass - ppm_error
+        upper_bound = precursor_mass + ppm_error
+        int_lower_bound = np.ceil(lower_bound*self.scale_factor).astype(np.int64)
+        int_upper_bound = np.floor(upper_bound*self.scale_factor + self.delta*upper_bound).astype(np.int64)
+        if np.ndim(int_lower_bound) == 0:
+            return int(int_lower_bound), int(int_upper_bound)
+        return int_lower_bound, int_upper_bound
+
+    def _find_candidates(self, precursor_mass, ppm, prune_rules=True):
+        ''' Returns the count matrix and masses of all the candidate formulas of precursor_mass.
+            Unless prune_rules is False, the formulas that can't pass rules 1 and 8 are not searched. '''
+
+        int_lower_bound, int_upper_bound = self._get_integer_bounds(precursor_mass, ppm)
+        max_counts = self._get_max_counts(int_lower_bound, int_upper_bound, prune_rules)
+        counts = []
+        masses = []
+        for int_mass in range(int_lower_bound, int_upper_bound+1):
+            for batch in self._decompose(int_mass, max_counts, [(precursor_mass, ppm)]):
+                batch_counts, batch_masses = self._filter_ppm(batch, self._get_masses(batch),
+                                                              ppm, precursor_mass)
+                counts.append(batch_counts)
+                masses.append(batch_masses)
+        return self._concatenate(counts, masses)
+
+    def _get_max_counts(self, int_lower_bound, int_upper_bound, prune_rules=True):
+        ''' Returns the maximum count of each atom allowed by the alphabet and, if prune_rules, 
+            the golden rules for the formulas found by decomposing the integer masses from 
+            int_lower_bound to int_upper_bound, or None if nothing limits them '''
+
+        if not (self.do_7_rules and prune_rules):
+            if all(max_count == INFINITE for max_count in self.alphabet.max_counts):
+                return None
+            return self.alphabet.max_counts
+
+        # The atom masses are scaled with ceil, so a formula of mass M decomposes an integer
+        # mass between M*scale_factor and M*(scale_factor + delta). Widened by one on both 
+        # sides to stay clear of rounding errors.
+        lower_mass = (int_lower_bound - 1) / (self.scale_factor + self.delta)
+        upper_mass = (int_upper_bound + 1) / float(self.scale_factor)
+        max_counts = self.gr.get_max_occurrences(self.atoms, lower_mass, upper_mass)
+        return [min(m, n) for m, n in zip(max_counts, self.alphabet.max_counts)]
+
+    def _find_candidates_batch(self, queries, work=None, prune_rules=True):
+        ''' Returns the candidate count matrix and masses of every (precursor_mass, ppm) query,
+            or None for queries that are None. The queries are swept in order of their integer
+            windows, overlapping windows are merged and every integer mass in them is decomposed
+            once, then handed to all the queries whose window contains it. If work is given, the 
+            integer masses, nodes and seconds spent on each integer mass are added to the 
+            [int_masses, nodes, seconds] of work[q] for all the queries q sharing it. prune_rules 
+            is as in _find_candidates. '''
+
+        windows = {}
+        searched = [q for q, query in enumerate(queries) if query is not None]
+        if searched:
+            precursor_masses = np.array([queries[q][0] for q in searched])
+            ppms = np.array([queries[q][1] for q in searched], dtype=float)
+            int_lower_bounds, int_upper_bounds = self._get_integer_bounds(precursor_masses, ppms)
+            windows = dict(zip(searched, zip(int_lower_bounds.tolist(), int_upper_bounds.tolist())))
+        order = sorted(windows, key=lambda q: windows[q])
+
+        # merge the overlapping integer windows into segments
+        segments = []
+        for q in order:
+            lower, upper = windows[q]
+            if segments and lower <= segments[-1][1]:
+                segments[-1][1] = max(segments[-1][1], upper)
+                segments[-1][2].append(q)
+            else:
+                segments.append([lower, upper, [q]])
+
+        found_counts = dict((q, []) for q in order)
+        found_masses = dict((q, []) for q in order)
+        for lower, upper, members in segments:
+            max_counts = self._get_max_counts(lower, upper, prune_rules)
+            active = []
+            next_member = 0
+            for int_mass in range(lower, upper+1):
+
+                # update the queries whose window contains int_mass, members are sorted by lower bound
+                while next_member < len(members) and windows[members[next_member]][0] <= int_mass:
+                    active.append(members[next_member])
+                    next_member += 1
+                active = [q for q in active if windows[q][1] >= int_mass]
+                if not active:
+                    continue
+
+                if work is not None:
+                    start = time.time()
+                    nodes_visited = self.nodes_visited
+                batches = list(self._decompose(int_mass, max_counts, [queries[q] for q in active]))
+                if batches:
+                    decompositions = np.concatenate(batches)
+                    decomposition_masses = self._get_masses(decompositions)
+                    for q in active:
+                        precursor_mass, ppm = queries[q]
+                        q_counts, q_masses = self._filter_ppm(decompositions, decomposition_masses,
+                                                              ppm, precursor_mass)
+                        found_counts[q].append(q_counts)
+                        found_masses[q].append(q_masses)
+
+                if work is not None:
+                    seconds = time.time() - start
+                    for q in active:
+                        work[q][0] += 1
+                        work[q][1] += self.nodes_visited - nodes_visited
+                        work[q][2] += seconds
+
+        results = [None for query in queries]
+        for q in order:
+            results[q] = self._concatenate(found_counts[q], found_masses[q])
+        return results
+
+    def _filter_ppm(self, counts, masses, ppm, precursor_mass):
+        ''' Returns the rows of counts and masses that are candidates for precursor_mass at ppm '''
+
+        if self.enforce_ppm:
             # The following corrects for the fact that at low scale factors we
             # will find things at much more than the specificed ppm
-            if self.enforce_ppm:
-                molecule_mass = 0.0
-                for i,atom in enumerate(self.atoms):
-                    molecule_mass += self.atom_masses[atom]*c[i]
-                if abs(molecule_mass - precursor_mass)/precursor_mass <= 1e-6*ppm:
-                    formulas.append(list(c))
+            within = np.abs(masses - precursor_mass)/precursor_mass <= 1e-6*ppm
+            return counts[within], masses[within]
+        else:
+            return counts, masses
 
-                return
-            else:
-                formulas.append(list(c))
-            return
+    def _get_masses(self, counts):
+        ''' Returns the exact masses of the formulas in the count matrix '''
+        return counts.dot(self.atom_mass_vector)
+
+    def _concatenate(self, counts, masses):
+        ''' Joins lists of count matrices and mass vectors into one of each '''
+        if counts:
+            return np.concatenate(counts), np.concatenate(masses)
         else:
-            lcm = self.a[0]*self.a[i] / fractions.gcd(self.a[0],self.a[i])
-            l = lcm/self.a[i]
-            for j in range(0,l):
-                c[i] = j
-                m = mass - j*self.a[i]
-                r = m % self.a[0]
-                lbound = self.rr[i-1][r]
-                while m >= lbound:
-                    self._find_all(m, i-1, c, ppm, precursor_mass)
-                    m = m - lcm
-                    c[i] = c[i] + l    
-
-    def _get_dictionary(self):
-        
-        atom_dict = []
-        for a in self.atoms:
-            atom_dict.append(int(ceil(self.atom_masses[a]*self.scale_factor)))
-        return atom_dict
+            return np.zeros((0, len(self.atoms)), dtype=np.int32), np.zeros(0)
+
+    def _filter_rules(self, counts):
+        ''' Returns a boolean mask of the rows of counts that pass the golden rules '''
+        passed, breakdown = self.gr.filter_matrix(counts, self.atoms)
+        return passed
+
+    def _adjust_hydrogen(self, counts, polarisation):
+        ''' Returns a copy of counts with the hydrogens of the charged formulas, or counts 
+            itself when there is no polarisation '''
+
+        if polarisation not in ("pos", "neg"):
+            return counts
+        if 'H' not in self.atoms:
+            raise ValueError("The " + polarisation + " polarisation needs H in the atoms " + str(self.atoms))
+        counts = counts.copy()
+        h = self.atoms.index('H')
+        if polarisation == "pos":
+            counts[:, h] += 1
+        elif polarisation == "neg":
+            counts[:, h] -= (counts[:, h] >= 1)
+        return counts
+
+    def _get_closest(self, counts, precursor_mass):
+        ''' Returns the row of counts whose mass is the closest to precursor_mass '''
+        errors = np.abs(self._get_masses(counts) - precursor_mass)
+        return np.argmin(errors)
+
+    def _get_best_isotope_match(self, counts, precursor_mass, intensities):
+        ''' Returns the row of counts whose isotope envelope is the most similar to the observed 
+            intensities, and among those the closest in mass to precursor_mass '''
+        scores = self.isotope_scorer.score(counts, self.atoms, intensities)
+        errors = np.abs(self._get_masses(counts) - precursor_mass)
+        return np.lexsort((errors, -scores))[0]
+
+    def _to_dicts(self, counts):
+        ''' Turns the rows of a count matrix into formula dictionaries keyed by atom name '''
+        return [dict(zip(self.atoms, row)) for row in counts.tolist()]
+
+    def _get_formula_string(self, formula):
+
+        f_string = ""
+        for atom in formula:
+
+            # print C13 as [C13]
+            atom_str = atom
+            if atom_str == 'C13':
+                atom_str = '[C13]'
+            if formula[atom]>1:
+                f_string += "{}{}".format(atom_str, formula[atom])
+            elif formula[atom] == 1:
+                f_string += "{}".format(atom_str)
+        return f_string
+
+    def _decompose(self, int_mass, max_counts, queries):
+        ''' Returns the batches of decompositions of int_mass for the (precursor_mass, ppm) 
+            queries. When tracking the rounding error, only the ones that can be within 
+            the ppm window of one of the queries are generated. '''
+
+        if not self.track_rounding_error:
+            return self._find_all(int_mass, max_counts)
+        lower_mass = min(precursor_mass - ppm*precursor_mass/1e6 for precursor_mass, ppm in queries)
+        upper_mass = max(precursor_mass + ppm*precursor_mass/1e6 for precursor_mass, ppm in queries)
+        return self._find_all_within(int_mass, lower_mass, upper_mass, max_counts)
+
+    def _find_all(self, mass, max_counts=None, batch_size=DECOMPOSITION_BATCH_SIZE):
+        ''' Enumerates all decompositions of the integer mass over self.a, yielding the 
+            count vectors in batches of (n, n_atoms) arrays. Uses an explicit stack instead 
+            of recursion, so no state is shared between calls and the method is re-entrant. 
+            If max_counts is given, the branches where the count of atom i goes above 
+            max_counts[i] are not expanded. '''
 
-    def _round_robin(self):
-    
         k = len(self.a)
-        a1 = self.a[0]
-        n = [INFINITE for r in range(0, a1)]
-        n[0] = 0
-        
-        rr = []
-        rr.append(list(n))
-
-        for i in range(1, k):
-            d = fractions.gcd(a1, self.a[i])
-            for p in range(0, d):
-                new_n = self._find_n(n, p, d)
-                if new_n < INFINITE:
-                    for repeat in range(1, a1/d):
-                        new_n = new_n + self.a[i]
-                        r = new_n % a1
-                        new_n = min(new_n, n[r])
-                        n[r] = new_n
-            
-            rr.append(list(n))
+        a = self.a
+        a1 = a[0]
+        rr = self.rr_rows
+        c = [0 for i in range(0, k)]
+        batch = []
+        if max_counts is None:
+            max_counts = [INFINITE for i in range(0, k)]
 
-        return rr
-    
-    def _find_n(self, n, p, d):
-
-        minimum = INFINITE
-        for q, elem in enumerate(n):
-            if q % d == p:
-                if elem < minimum:
-                    minimum = elem
-        return minimum
+        # each stack entry is (level, remaining mass, count of the atom one level up), 
+        # the children of a node are pushed in reverse so that the order of the 
+        # decompositions is the same as the original recursive implementation
+        stack = [(k-1, mass, None)]
+        nodes = 0
+        while stack:
+            nodes += 1
+            i, m, parent_count = stack.pop()
+            if i < k-1:
+                c[i+1] = parent_count
+            if i == 0:
+                c[0] = m / a1
+                if c[0] > max_counts[0]:
+                    continue
+                batch.append(list(c))
+                if len(batch) >= batch_size:
+                    self.nodes_visited += nodes
+                    nodes = 0
+                    yield np.array(batch, dtype=np.int32)
+                    batch = []
+                continue
+            lcm = self.lcm[i]
+            l = lcm / a[i]
+            lower = rr[i-1]
+            max_count = max_counts[i]
+            children = []
+            for j in range(0, min(l, max_count+1)):
+                count = j
+                m_i = m - j*a[i]
+                lbound = lower[m_i % a1]
+                while m_i >= lbound and count <= max_count:
+                    children.append((i-1, m_i, count))
+                    m_i = m_i - lcm
+                    count = count + l
+            children.reverse()
+            stack.extend(children)
+
+        self.nodes_visited += nodes
+        if batch:
+            yield np.array(batch, dtype=np.int32)
+
+    def _find_all_within(self, mass, lower_mass, upper_mass, max_counts=None, batch_size=DECOMPOSITION_BATCH_SIZE):
+        ''' Same as _find_all, but only yields the decompositions of the integer mass whose real 
+            mass can be between lower_mass and upper_mass. Scaling atom i up with ceil adds 
+            a rounding error e_i = a_i - scale_factor*m_i, so a decomposition has a real mass of 
+            (mass - sum c_i*e_i)/scale_factor. The error of the counts fixed so far is carried 
+            along each branch, and the error of the rest of the remaining mass m is between 
+            m*min(e_i/a_i) and m*max(e_i/a_i) over the atoms left, so the branches that can no
+            longer reach the mass window are not expanded. '''
+
+        k = len(self.a)
+        a = self.a
+        a1 = a[0]
+        rr = self.rr_rows
+        e = self.rounding_errors
+        min_rates = self.min_error_rates
+        max_rates = self.max_error_rates
+        c = [0 for i in range(0, k)]
+        batch = []
+        if max_counts is None:
+            max_counts = [INFINITE for i in range(0, k)]
+
+        # the range of the total rounding error giving a real mass in the window, with some slack 
+        # for floating point errors. The ppm check is still done exactly on the results.
+        slack = 1e-9*mass
+        min_error = mass - self.scale_factor*upper_mass - slack
+        max_error = mass - self.scale_factor*lower_mass + slack
+        if mass*min_rates[k-1] > max_error or mass*max_rates[k-1] < min_error:
+            return
+
+        # as in _find_all, plus the rounding error of the counts fixed so far
+        stack = [(k-1, mass, None, 0.0)]
+        nodes = 0
+        while stack:
+            nodes += 1
+            i, m, parent_count, error = stack.pop()
+            if i < k-1:
+                c[i+1] = parent_count
+            if i == 0:
+                c[0] = m / a1
+                if c[0] > max_counts[0]:
+                    continue
+                batch.append(list(c))
+                if len(batch) >= batch_size:
+                    self.nodes_visited += nodes
+                    nodes = 0
+                    yield np.array(batch, dtype=np.int32)
+                    batch = []
+                continue
+            lcm = self.lcm[i]
+            l = lcm / a[i]
+            lower = rr[i-1]
+            max_count = max_counts[i]
+            e_i = e[i]
+            min_rate = min_rates[i-1]
+            max_rate = max_rates[i-1]
+            children = []
+            for j in range(0, min(l, max_count+1)):
+                count = j
+                m_i = m - j*a[i]
+                lbound = lower[m_i % a1]
+                while m_i >= lbound and count <= max_count:
+                    child_error = error + count*e_i
+                    if child_error + m_i*min_rate <= max_error and child_error + m_i*max_rate >= min_error:
+                        children.append((i-1, m_i, count, child_error))
+                    m_i = m_i - lcm
+                    count = count + l
+            children.reverse()
+            stack.extend(children)
+
+        self.nodes_visited += nodes
+        if batch:
+            yield np.array(batch, dtype=np.int32)
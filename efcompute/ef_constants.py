@@ -18,9 +18,79 @@ ATOM_VALENCE_LIST = [1, 4, 4, 3, 2, 1, 3, 2, 1]
 ATOM_MASSES = dict(zip(ATOM_NAME_LIST, ATOM_MASS_LIST))
 ATOM_VALENCES = dict(zip(ATOM_NAME_LIST, ATOM_VALENCE_LIST))
 
+# the other elements that an element_alphabet can have, as (name, mass, valence)
+OTHER_ELEMENTS = [('Na', 22.98976928, 1), ('Si', 27.97692653, 4), ('K', 38.96370668, 1),
+                  ('Br', 78.91833710, 1), ('I', 126.90447300, 1)]
+ELEMENT_MASSES = dict(ATOM_MASSES)
+ELEMENT_VALENCES = dict(ATOM_VALENCES)
+for name, mass, valence in OTHER_ELEMENTS:
+    ELEMENT_MASSES[name] = mass
+    ELEMENT_VALENCES[name] = valence
+
+# the element limits of rule #1, from table 1 in the 7 golden rules paper, using the largest 
+# of the two sets. Each entry is (mass limit, (c, h, n, o, p, s, f, cl, br)) and applies to 
+# formulas lighter than the mass limit. Only the counts of RULE_1_ELEMENTS are checked.
+RULE_1_ELEMENT_LIMITS = [(500,  (39, 72, 20, 20, 9, 10, 16, 10, 5)),
+                         (1000, (78, 126, 25, 27, 9, 14, 34, 12, 8)),
+                         (2000, (156, 236, 32, 63, 9, 12, 48, 12, 10)),
+                         (3000, (162, 208, 48, 78, 6, 9, 16, 11, 8))]
+RULE_1_ELEMENTS = ['C', 'H', 'N', 'O', 'P', 'S']
+
 # all the rules are turned on by default
 DEFAULT_RULES_SWITCH = [True, True, True, True, True, True, True, True]
 
+# the relative cost of checking each rule, used with the rejection rate of each rule to 
+# check the rules that are most likely to reject a formula for the least work first
+RULE_COSTS = [4.0, 3.0, 1.0, 1.5, 2.0, 2.0, 1.0, 1.5]
+
+# number of formulas filtered between two reorderings of the golden rules
+RULE_REORDER_INTERVAL = 1000
+
 RULE_8_MAX_OCCURRENCES = {}
 for name in ATOM_NAME_LIST:
-    RULE_8_MAX_OCCURRENCES[name] = INFINITE
\ No newline at end of file
+    RULE_8_MAX_OCCURRENCES[name] = INFINITE
+
+# number of candidate count vectors yielded at a time by ef_assigner._find_all
+DECOMPOSITION_BATCH_SIZE = 1000
+
+# bump this whenever the layout of the round-robin table changes, to invalidate the
+# tables previously cached by ef_assigner
+RR_CACHE_VERSION = 1
+
+# bump this whenever the layout of the files written by formula_index.build_formula_index changes
+FORMULA_INDEX_VERSION = 1
+
+# ef_assigner caches its results by neutral mass rounded to this many decimals, 
+# so masses that agree to 1e-6 Da share their candidate formulas
+RESULT_CACHE_MASS_DECIMALS = 6
+
+# the natural abundances of the isotopes of each atom at nominal masses M+0, M+1 and M+2, 
+# used to compute the isotope envelopes of the candidate formulas. C13 is a labelled carbon, 
+# so it only has one isotope.
+ISOTOPE_ABUNDANCES = {'H':   (0.999885, 0.000115, 0.0),
+                      'C':   (0.9893,   0.0107,   0.0),
+                      'C13': (1.0,      0.0,      0.0),
+                      'N':   (0.99636,  0.00364,  0.0),
+                      'O':   (0.99757,  0.00038,  0.00205),
+                      'F':   (1.0,      0.0,      0.0),
+                      'P':   (1.0,      0.0,      0.0),
+                      'S':   (0.9499,   0.0075,   0.0425),
+                      'Cl':  (0.7576,   0.0,      0.2424),
+                      'Na':  (1.0,      0.0,      0.0),
+                      'Si':  (0.92223,  0.04685,  0.03092),
+                      'K':   (0.932581, 0.000117, 0.067302),
+                      'Br':  (0.5069,   0.0,      0.4931),
+                      'I':   (1.0,      0.0,      0.0)}
+
+# the adducts searched by ef_assigner.find_formulas_adducts, as (mass shift, multiplicity/charge), 
+# so the neutral mass of an ion is (m/z - mass shift)/(multiplicity/charge), as in mulsub.txt
+WATER_MASS = 2*ATOM_MASSES['H'] + ATOM_MASSES['O']
+ADDUCTS = {'M+H':       (PROTON_MASS, 1.0),
+           'M+NH4':     (18.03382555509076, 1.0),
+           'M+Na':      (22.98922108009076, 1.0),
+           'M+K':       (38.963158320090756, 1.0),
+           '2M+H':      (PROTON_MASS, 2.0),
+           'M-H2O+H':   (PROTON_MASS - WATER_MASS, 1.0),
+           'M-H':       (-PROTON_MASS, 1.0),
+           'M+Cl':      (34.96940129009076, 1.0)}
+DEFAULT_ADDUCTS = ['M+H', 'M+Na', 'M+K', 'M+NH4', '2M+H', 'M-H2O+H']
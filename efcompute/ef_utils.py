@@ -0,0 +1,20 @@
+import os
+import tempfile
+
+import numpy as np
+
+def save_array(path, array):
+    ''' Saves array as the .npy file path, creating its directory if needed. The array is 
+        written to a temporary file in the same directory that is then renamed, so that the 
+        processes loading the file at the same time never see it partially written. '''
+
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+    fd, temp_path = tempfile.mkstemp(suffix='.npy', dir=directory)
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, array)
+    os.rename(temp_path, path)
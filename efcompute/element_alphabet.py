@@ -0,0 +1,170 @@
+import os
+import fractions
+import hashlib
+from collections import namedtuple
+from math import ceil
+
+import numpy as np
+
+from ef_utils import save_array
+from ef_constants import INFINITE, ATOM_NAME_LIST, ELEMENT_MASSES, ELEMENT_VALENCES, RR_CACHE_VERSION
+
+# max_count is a hard limit on the count of the element in the formulas searched
+element = namedtuple('element', ['name', 'mass', 'valence', 'max_count'])
+
+class element_alphabet(object):
+    '''
+    The elements that formulas are made of, sorted by strictly increasing mass, which also
+    goes from the least to the most constrained one. The first, lightest element is the modulus
+    of the round-robin tables, so it must be the most common one (usually H).
+
+    An alphabet owns the integer mass dictionary and the round-robin table of each scale
+    factor it is used with, so all the assigners using the same alphabet share one copy.
+    Alphabets are never modified, without() makes a new one.
+    '''
+
+    def __init__(self, elements):
+        elements = list(elements)
+        if not elements:
+            raise ValueError("An element alphabet needs at least one element")
+        names = [e.name for e in elements]
+        if len(set(names)) != len(names):
+            raise ValueError("Duplicate elements in " + str(names))
+        for e in elements:
+            if e.mass <= 0 or e.valence <= 0 or e.max_count < 0:
+                raise ValueError("Invalid element " + str(e))
+        for previous, e in zip(elements, elements[1:]):
+            if e.mass <= previous.mass:
+                raise ValueError("The elements must be sorted by strictly increasing mass, but " +
+                                 e.name + " is not heavier than " + previous.name)
+
+        self.elements = elements
+        self.names = names
+        self.masses = dict((e.name, e.mass) for e in elements)
+        self.valences = dict((e.name, e.valence) for e in elements)
+        self.max_counts = [e.max_count for e in elements]
+        self.dictionaries = {}
+        self.round_robins = {}
+        self.round_robin_rows = {}
+        self.derived = {}
+
+    @staticmethod
+    def from_names(names, max_counts=None):
+        ''' Makes an alphabet of the named elements, sorted by mass, using the masses and
+            valences in ef_constants and the max counts in the max_counts dictionary '''
+        max_counts = max_counts or {}
+        names = sorted(names, key=lambda name: ELEMENT_MASSES[name])
+        return element_alphabet([element(name, ELEMENT_MASSES[name], ELEMENT_VALENCES[name],
+                                         max_counts.get(name, INFINITE)) for name in names])
+
+    def without(self, names):
+        ''' Returns the alphabet without the named elements. The same alphabet is returned for
+            the same names, so its tables are only built once. '''
+
+        key = frozenset(n for n in names if n in self.masses)
+        if not key:
+            return self
+        if key not in self.derived:
+            self.derived[key] = element_alphabet([e for e in self.elements if e.name not in key])
+        return self.derived[key]
+
+    def get_dictionary(self, scale_factor):
+        ''' Returns the element masses scaled by scale_factor and rounded up '''
+
+        if scale_factor not in self.dictionaries:
+            self.dictionaries[scale_factor] = [int(ceil(e.mass*scale_factor)) for e in self.elements]
+        return self.dictionaries[scale_factor]
+
+    def get_round_robin(self, scale_factor, cache_dir=None):
+        ''' Returns the round-robin table of scale_factor as a (k, a1) array. If cache_dir is given,
+            the table is memory-mapped from there when it has been built before for the same
+            elements and scale factor, otherwise it's built once and saved for the next time. '''
+
+        if scale_factor not in self.round_robins:
+            self.round_robins[scale_factor] = self._load_round_robin(scale_factor, cache_dir)
+        elif cache_dir is not None:
+            # the table may have been built without a cache_dir, or saved in another one
+            path = self._round_robin_path(scale_factor, cache_dir)
+            if not os.path.isfile(path):
+                save_array(path, self.round_robins[scale_factor])
+        return self.round_robins[scale_factor]
+
+    def get_round_robin_rows(self, scale_factor, cache_dir=None):
+        ''' Returns the round-robin table of scale_factor as a list of lists '''
+
+        if scale_factor not in self.round_robin_rows:
+            self.round_robin_rows[scale_factor] = self.get_round_robin(scale_factor, cache_dir).tolist()
+        return self.round_robin_rows[scale_factor]
+
+    def _load_round_robin(self, scale_factor, cache_dir):
+
+        a = self.get_dictionary(scale_factor)
+        if cache_dir is None:
+            return self._round_robin(a)
+
+        path = self._round_robin_path(scale_factor, cache_dir)
+        shape = (len(a), a[0])
+        if os.path.isfile(path):
+            try:
+                rr = np.load(path, mmap_mode='r')
+                if rr.shape == shape and rr.dtype == np.int64:
+                    return rr
+            except (IOError, ValueError):
+                pass # corrupted, so build it again below
+
+        # workers starting at the same time never load a partially-written table
+        save_array(path, self._round_robin(a))
+        return np.load(path, mmap_mode='r')
+
+    def _round_robin_path(self, scale_factor, cache_dir):
+
+        return os.path.join(cache_dir, self._round_robin_key(scale_factor) + '.npy')
+
+    def _round_robin_key(self, scale_factor):
+        ''' The cache file name of the round-robin table for these elements and scale factor '''
+
+        masses = [repr(e.mass) for e in self.elements]
+        key = repr((RR_CACHE_VERSION, self.names, masses, scale_factor))
+        return 'rr_' + hashlib.sha1(key).hexdigest()
+
+    def _round_robin(self, a):
+        ''' Builds the round-robin (extended residue) table of the integer masses a. Row i holds,
+            for every residue r modulo a1, the smallest mass decomposable over the first i+1
+            elements that is congruent to r, or INFINITE if there isn't one. '''
+
+        k = len(a)
+        a1 = a[0]
+        n = np.empty(a1, dtype=np.int64)
+        n.fill(INFINITE)
+        n[0] = 0
+
+        rr = np.empty((k, a1), dtype=np.int64)
+        rr[0] = n
+
+        for i in range(1, k):
+            ai = a[i]
+            d = fractions.gcd(a1, ai)
+            length = a1/d
+
+            # The residues fall into d classes, r % d == p, and adding ai cycles through
+            # each class in a1/d steps. Walking a cycle from its smallest entry, the update
+            # n[r_t] = min(n[r_t], n[r_t-1] + ai) is a running minimum of n[r_t] - t*ai.
+            # The classes are the columns of n viewed as a (a1/d, d) array.
+            classes = n.reshape(length, d).T
+            start = np.arange(d) + classes.argmin(axis=1)*d
+            steps = np.arange(length, dtype=np.int64)*ai
+            cycles = (start[:, None] + steps[None, :]) % a1
+
+            # classes that are all INFINITE stay INFINITE: their running minimum is
+            # INFINITE - t*ai, which steps[t] adds back exactly
+            shifted = n[cycles] - steps[None, :]
+            n[cycles] = np.minimum.accumulate(shifted, axis=1) + steps[None, :]
+            rr[i] = n
+
+        return rr
+
+    def __repr__(self):
+        return "element_alphabet " + str(self.names)
+
+# the alphabet of ATOM_NAME_LIST, with no limits on the counts
+DEFAULT_ALPHABET = element_alphabet.from_names(ATOM_NAME_LIST)
@@ -0,0 +1,129 @@
+import os
+import sys
+import json
+
+import numpy as np
+
+from golden_rules import golden_rules
+from ef_utils import save_array
+from ef_constants import ATOM_NAME_LIST, ELEMENT_MASSES, DEFAULT_RULES_SWITCH, FORMULA_INDEX_VERSION
+
+RECORDS_FILE = 'formulas.npy'
+INFO_FILE = 'index.json'
+
+class formula_index(object):
+    '''
+    A pre-built index of all the formulas up to max_mass that pass the golden rules, sorted by
+    their exact mass. Every record holds the mass and the count of each atom. The records are
+    memory-mapped, so all the processes on a box share one copy, and the formulas in a mass
+    window are found by binary search. Use build_formula_index() to create one.
+    '''
+
+    def __init__(self, path):
+        with open(os.path.join(path, INFO_FILE), 'r') as f:
+            info = json.load(f)
+        if info['version'] != FORMULA_INDEX_VERSION:
+            raise ValueError("Formula index in " + path + " has version " + str(info['version']) +
+                             ", expected " + str(FORMULA_INDEX_VERSION))
+        self.path = path
+        self.max_mass = info['max_mass']
+        self.rule_switch = info['rule_switch']
+        self.rule_8_max_occurrences = info['rule_8_max_occurrences']
+        self.records = np.load(os.path.join(path, RECORDS_FILE), mmap_mode='r')
+        self.atoms = [name for name in self.records.dtype.names if name != 'mass']
+        self.masses = self.records['mass']
+
+    def find(self, lower_mass, upper_mass, atoms):
+        ''' Returns the count matrix, with columns in the order of atoms, and the masses of
+            all the formulas in the index with lower_mass <= mass <= upper_mass that are
+            made of atoms only '''
+
+        start = np.searchsorted(self.masses, lower_mass, side='left')
+        end = np.searchsorted(self.masses, upper_mass, side='right')
+        hits = self.records[start:end]
+
+        usable = np.ones(len(hits), dtype=bool)
+        for a in self.atoms:
+            if a not in atoms:
+                usable &= hits[a] == 0
+        hits = hits[usable]
+
+        counts = np.zeros((len(hits), len(atoms)), dtype=np.int32)
+        for i, a in enumerate(atoms):
+            counts[:, i] = hits[a]
+        return counts, np.array(hits['mass'])
+
+    def __repr__(self):
+        return "formula_index path=%s atoms=%s max_mass=%s formulas=%d" % (self.path, self.atoms,
+                                                                         self.max_mass, len(self.records))
+
+def build_formula_index(path, max_mass, atoms=None, rule_switch=DEFAULT_RULES_SWITCH,
+                        rule_8_max_occurrences=None, chunk_size=100000):
+    '''
+    Enumerates all the formulas over atoms with a mass up to max_mass that pass the golden rules,
+    and stores them sorted by mass in the directory path. Returns the formula_index.
+
+    The atoms must be sorted by increasing mass, the first one is enumerated last, chunk_size
+    partial formulas at a time, and these chunks are filtered by the golden rules as they are made.
+    '''
+
+    if atoms is None:
+        atoms = [a for a in ATOM_NAME_LIST if a not in ('C13', 'F', 'Cl')]
+    k = len(atoms)
+    atom_masses = np.array([ELEMENT_MASSES[a] for a in atoms])
+    rule_switch = list(rule_switch)
+    rule_switch[7] = rule_8_max_occurrences is not None
+    gr = golden_rules(rule_switch, rule_8_max_occurrences)
+    max_counts = gr.get_max_occurrences(atoms, 0, max_mass)
+
+    # all the partial formulas over atoms[1:] that are light enough
+    prefixes, prefix_masses = _expand(np.zeros((1, k), dtype=np.int16), np.zeros(1),
+                                      range(k-1, 0, -1), atom_masses, max_counts, max_mass)
+
+    # then add the first atom and filter, chunk by chunk
+    records = []
+    for start in range(0, len(prefixes), chunk_size):
+        counts, masses = _expand(prefixes[start:start+chunk_size], prefix_masses[start:start+chunk_size],
+                                 [0], atom_masses, max_counts, max_mass)
+        passed, breakdown = gr.filter_matrix(counts, atoms)
+        chunk = np.zeros(passed.sum(), dtype=[('mass', '<f8')] + [(a, '<i2') for a in atoms])
+        chunk['mass'] = counts[passed].dot(atom_masses)
+        for i, a in enumerate(atoms):
+            chunk[a] = counts[passed, i]
+        records.append(chunk)
+    records = np.concatenate(records)
+    records = records[np.argsort(records['mass'], kind='mergesort')]
+
+    save_array(os.path.join(path, RECORDS_FILE), records)
+    info = {'version': FORMULA_INDEX_VERSION, 'max_mass': max_mass, 'rule_switch': rule_switch,
+            'rule_8_max_occurrences': rule_8_max_occurrences}
+    with open(os.path.join(path, INFO_FILE), 'w') as f:
+        json.dump(info, f)
+
+    return formula_index(path)
+
+def _expand(counts, masses, columns, atom_masses, max_counts, max_mass):
+    ''' Expands each row of counts by every possible count of the atoms in columns,
+        keeping the formulas that are not heavier than max_mass '''
+
+    for i in columns:
+        room = np.floor((max_mass - masses) / atom_masses[i]).astype(np.int64)
+        repeats = np.minimum(room, max_counts[i]) + 1
+        counts = np.repeat(counts, repeats, axis=0)
+        masses = np.repeat(masses, repeats)
+        starts = np.repeat(np.cumsum(repeats) - repeats, repeats)
+        added = np.arange(len(counts)) - starts
+        counts[:, i] = added
+        masses = masses + added*atom_masses[i]
+    return counts, masses
+
+if __name__=='__main__':
+
+    if len(sys.argv) < 3:
+        print "Usage: python formula_index.py <index directory> <max mass> [comma separated atoms]"
+        sys.exit(1)
+    atoms = None
+    if len(sys.argv) > 3:
+        atoms = sorted(sys.argv[3].split(','), key=lambda a: ELEMENT_MASSES[a])
+    index = build_formula_index(sys.argv[1], float(sys.argv[2]), atoms)
+    print index
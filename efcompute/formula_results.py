@@ -0,0 +1,110 @@
+import os
+
+import numpy as np
+
+from ef_utils import save_array
+
+CANDIDATES_FILE = 'candidates.npy'
+QUERIES_FILE = 'queries.npy'
+
+# bit i of the rules field is set when rule i+1 passed or is switched off
+ALL_RULES_PASSED = 0xFF
+
+QUERY_DTYPE = [('mass', '<f8'), ('precursor_mass', '<f8'), ('ppm', '<f8')]
+
+def get_candidate_dtype(atoms):
+    ''' The record type of the candidate formulas over atoms '''
+    return [('query', '<i4')] + [(a, '<i2') for a in atoms] + \
+           [('mass', '<f8'), ('ppm_error', '<f8'), ('rules', 'u1')]
+
+def get_rule_mask(rule_switch, breakdown):
+    ''' Turns the (n, n_enabled_rules) breakdown of golden_rules.filter_matrix into
+        the rules field of the candidates '''
+
+    mask = np.zeros(len(breakdown), dtype=np.uint8)
+    column = 0
+    for i, switch in enumerate(rule_switch):
+        if switch:
+            mask |= breakdown[:, column].astype(np.uint8) << i
+            column += 1
+        else:
+            mask |= np.uint8(1 << i)
+    return mask
+
+class formula_results(object):
+    '''
+    The candidate formulas of a list of masses, stored by column. queries has the mass,
+    the neutral precursor mass and the tolerance of every mass of the list, with a NaN
+    precursor mass for the masses that weren't searched. candidates has one record per
+    neutral candidate formula, sorted by query index, with the count of every atom, its
+    exact mass, its error in ppm and which golden rules it passed.
+
+    Both arrays can be saved as .npy files and memory-mapped back by load(), so the
+    results can be handed to another process without pickling.
+    '''
+
+    def __init__(self, queries, candidates):
+        self.queries = queries
+        self.candidates = candidates
+        self.atoms = [name for name in candidates.dtype.names
+                      if name not in ('query', 'mass', 'ppm_error', 'rules')]
+        self.query_index = candidates['query']
+
+    @staticmethod
+    def load(path):
+        ''' Memory-maps the results saved in the directory path '''
+        queries = np.load(os.path.join(path, QUERIES_FILE), mmap_mode='r')
+        candidates = np.load(os.path.join(path, CANDIDATES_FILE), mmap_mode='r')
+        return formula_results(queries, candidates)
+
+    def save(self, path):
+        ''' Saves the results as .npy files in the directory path '''
+
+        for name, array in [(QUERIES_FILE, self.queries), (CANDIDATES_FILE, self.candidates)]:
+            save_array(os.path.join(path, name), array)
+
+    def get_counts(self, rows=None):
+        ''' Returns the count matrix of the candidates in rows, or of all of them '''
+        candidates = self.candidates if rows is None else self.candidates[rows]
+        return np.column_stack([candidates[a] for a in self.atoms]).astype(np.int32)
+
+    def get_passed(self):
+        ''' Returns the mask of the candidates passing all the golden rules '''
+        return self.candidates['rules'] == ALL_RULES_PASSED
+
+    def get_rows(self, q):
+        ''' Returns the slice of the candidates of query q '''
+        start = np.searchsorted(self.query_index, q, side='left')
+        end = np.searchsorted(self.query_index, q, side='right')
+        return slice(start, end)
+
+    def get_formulas(self, q, passed_only=True):
+        ''' Returns the candidates of query q as formula dictionaries '''
+
+        rows = np.arange(len(self.candidates))[self.get_rows(q)]
+        if passed_only:
+            rows = rows[self.get_passed()[rows]]
+        return [dict(zip(self.atoms, row)) for row in self.get_counts(rows).tolist()]
+
+    def get_top_hits(self):
+        ''' Returns the row of the candidate passing the golden rules that is the closest
+            in mass to each query, or -1 if there isn't one '''
+
+        rows = np.flatnonzero(self.get_passed())
+        errors = np.abs(self.candidates['ppm_error'][rows])
+        queries = self.query_index[rows]
+        order = np.lexsort((errors, queries))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = queries[order][1:] != queries[order][:-1]
+
+        top_hits = np.empty(len(self.queries), dtype=np.int64)
+        top_hits.fill(-1)
+        top_hits[queries[order][first]] = rows[order][first]
+        return top_hits
+
+    def __len__(self):
+        return len(self.candidates)
+
+    def __repr__(self):
+        return "formula_results queries=%d candidates=%d atoms=%s" % (len(self.queries), len(self.candidates),
+                                                                     self.atoms)
@@ -1,15 +1,43 @@
-from ef_constants import ATOM_MASSES, ATOM_VALENCES, DEFAULT_RULES_SWITCH, INFINITE, RULE_8_MAX_OCCURRENCES
+import numpy as np
+
+from ef_constants import DEFAULT_RULES_SWITCH, INFINITE, RULE_8_MAX_OCCURRENCES, \
+    RULE_1_ELEMENT_LIMITS, RULE_1_ELEMENTS, ELEMENT_MASSES, ELEMENT_VALENCES, RULE_COSTS, RULE_REORDER_INTERVAL
 
 class golden_rules(object):
 
-    def __init__(self, rule_switch=DEFAULT_RULES_SWITCH, rule_8_max_occurrences=None):
+    def __init__(self, rule_switch=DEFAULT_RULES_SWITCH, rule_8_max_occurrences=None, alphabet=None,
+                 diagnostic=False):
         self.rule_switch = rule_switch
         self.rule_8_max_occurrences = rule_8_max_occurrences
 
+        # the limits of rule 8, the default values updated with the user-defined ones
+        self.max_occurrences = dict(RULE_8_MAX_OCCURRENCES)
+        if rule_8_max_occurrences is not None:
+            self.max_occurrences.update(rule_8_max_occurrences)
+
+        # Unless diagnostic is on, the filters stop at the first rule that fails and don't return 
+        # the breakdown of the results of each rule. The enabled rules are then tried in order of 
+        # their rejection rate per unit of cost, measured on the formulas filtered so far and 
+        # updated every RULE_REORDER_INTERVAL formulas.
+        self.diagnostic = diagnostic
+        self.enabled_rules = [i for i, switch in enumerate(rule_switch) if switch]
+        self.rule_order = list(self.enabled_rules)
+        self.evaluations = [0 for switch in rule_switch]
+        self.rejections = [0 for switch in rule_switch]
+        self.since_reorder = 0
+
+        # the masses and valences used by the rules
+        if alphabet is None:
+            self.masses = ELEMENT_MASSES
+            self.valences = ELEMENT_VALENCES
+        else:
+            self.masses = alphabet.masses
+            self.valences = alphabet.valences
+
     def get_formula_mass(self, formula):
         mass = 0.0
         for a in formula:
-            mass += ATOM_MASSES[a]*formula[a]
+            mass += self.masses[a]*formula[a]
         return mass
 
     def element_numbers_restriction(self, formula, c, h, n, o, p, s, f, cl, br):
@@ -27,8 +55,8 @@ class golden_rules(object):
         :param restrict:  boolean which if true indicates to use only CHNOPS
         :return: True if the formula is outside restrictions
         """
-        if formula['C'] > c or formula['H'] > h or formula['N'] > n or formula['O'] > o or formula[
-            'P'] > p or formula['S'] > s:
+        if formula.get('C', 0) > c or formula.get('H', 0) > h or formula.get('N', 0) > n or \
+                formula.get('O', 0) > o or formula.get('P', 0) > p or formula.get('S', 0) > s:
             return True
         else:
             return False
@@ -42,18 +70,11 @@ class golden_rules(object):
         :return: true if it passes the test
         """
         mass = self.get_formula_mass(formula)
-        if mass < 500:
-            if self.element_numbers_restriction(formula, 39, 72, 20, 20, 9, 10, 16, 10, 5): # c, h, n, o, p, s, f, cl, br
-                return False
-        elif mass < 1000:
-            if self.element_numbers_restriction(formula, 78, 126, 25, 27, 9, 14, 34, 12, 8):
-                return False
-        elif mass < 2000:
-            if self.element_numbers_restriction(formula, 156, 236, 32, 63, 9, 12, 48, 12, 10):
-                return False
-        elif mass < 3000:
-            if self.element_numbers_restriction(formula, 162, 208, 48, 78, 6, 9, 16, 11, 8):
-                return False
+        for mass_limit, element_limits in RULE_1_ELEMENT_LIMITS:
+            if mass < mass_limit:
+                if self.element_numbers_restriction(formula, *element_limits):
+                    return False
+                break
         return True
 
 
@@ -70,7 +91,7 @@ class golden_rules(object):
         valence_sum = 0
         atoms = 0
         for element, number in formula.iteritems():
-            valence_sum += ATOM_VALENCES[element] * number
+            valence_sum += self.valences[element] * number
             atoms += number
         if not (valence_sum % 2 == 0 and valence_sum >= 2 * (atoms - 1)):
             return False
@@ -89,7 +110,7 @@ class golden_rules(object):
         :param formula: a formula
         :return: True if the formula passed this test
         """
-        if formula['C'] > 0 and formula['H'] > 0:
+        if formula.get('C', 0) > 0 and formula.get('H', 0) > 0:
             h_c_ratio = (1.0*formula['H']) / (1.0*formula['C'])
             if not (6 > h_c_ratio > 0.1):
                 return False
@@ -101,11 +122,11 @@ class golden_rules(object):
         :param formula: a formula
         :return: True if the formula passed this test
         """
-        if formula['C'] > 0:
-            n_c_ratio = formula['N'] / formula['C'] * 1.0
-            o_c_ratio = formula['O'] / formula['C'] * 1.0
-            p_c_ratio = formula['P'] / formula['C'] * 1.0
-            s_c_ratio = formula['S'] / formula['C'] * 1.0
+        if formula.get('C', 0) > 0:
+            n_c_ratio = formula.get('N', 0) / formula['C'] * 1.0
+            o_c_ratio = formula.get('O', 0) / formula['C'] * 1.0
+            p_c_ratio = formula.get('P', 0) / formula['C'] * 1.0
+            s_c_ratio = formula.get('S', 0) / formula['C'] * 1.0
             if not (4 > n_c_ratio and 3 > o_c_ratio and 2 > p_c_ratio and 3 > s_c_ratio):
                 return False
         return True
@@ -116,10 +137,10 @@ class golden_rules(object):
         :param formula: a formula
         :return: True if the formula passed this test
         """
-        n = formula['N']
-        o = formula['O']
-        p = formula['P']
-        s = formula['S']
+        n = formula.get('N', 0)
+        o = formula.get('O', 0)
+        p = formula.get('P', 0)
+        s = formula.get('S', 0)
         if (n > 1 and o > 1 and p > 1 and s > 1 and not (n < 10 and o < 20 and p < 4 and s < 3)) or \
                 (n > 3 and p > 3 and p > 3 and not (n < 11 and o < 22 and p < 6)) or \
                 (o > 1 and p > 1 and s > 1 and not (o < 14 and p < 3 and s < 3)) or \
@@ -142,9 +163,7 @@ class golden_rules(object):
         :param formula: a formula
         :return: True if the formula passed this test
         """
-        max_occurrences = dict(RULE_8_MAX_OCCURRENCES) # use the default values initially
-        if self.rule_8_max_occurrences is not None:
-            max_occurrences.update(self.rule_8_max_occurrences) # and update to the user-defined values
+        max_occurrences = self.max_occurrences
             
         valid = True
         for key in max_occurrences:
@@ -165,7 +184,27 @@ class golden_rules(object):
                 f_string += "{}{}".format(a, formula[a])
         return f_string
 
-    def filter_formula(self, formula):
+    def filter_formula(self, formula, diagnostic=None):
+        """
+        checks formula against all the enabled rules
+        :param formula: a formula
+        :param diagnostic: overrides the diagnostic mode of this object if not None
+        :return: True if the formula passed all the rules, and the list of the result of every 
+        enabled rule in diagnostic mode, None otherwise
+        """
+        if diagnostic is None:
+            diagnostic = self.diagnostic
+        if not diagnostic:
+            rules = [self.rule1, self.rule2, self.rule3, self.rule4, self.rule5, self.rule6, self.rule7, self.rule8]
+            for i in self.rule_order:
+                self.evaluations[i] += 1
+                if not rules[i](formula):
+                    self.rejections[i] += 1
+                    self._count_filtered(1)
+                    return False, None
+            self._count_filtered(1)
+            return True, None
+
         result = True
         breakdown = []
         if self.rule_switch[0]:
@@ -204,14 +243,198 @@ class golden_rules(object):
         return result, breakdown
 
     def filter_list(self, formula_list):
+        """
+        checks every formula of formula_list against all the enabled rules, always in 
+        diagnostic mode so the rules failed by every formula are known
+        :param formula_list: a list of formulas
+        :return: the formulas that passed, their strings, and a dictionary of the list of 
+        the result of every enabled rule of the formulas that failed, keyed by their strings
+        """
         filtered_formulas = []
         passed = []
         failed = {}
         for formula in formula_list:
-            result,breakdown = self.filter_formula(formula)
+            result,breakdown = self.filter_formula(formula, diagnostic=True)
             if result:
                 filtered_formulas.append(formula)
                 passed.append(self.make_formula_string(formula))
             else:
                 failed[self.make_formula_string(formula)] = breakdown
-        return filtered_formulas,passed,failed
\ No newline at end of file
+        return filtered_formulas,passed,failed
+
+    def get_max_occurrences(self, atoms, lower_mass, upper_mass):
+        """
+        upper limits on the number of each element in any formula with a mass between 
+        lower_mass and upper_mass that can pass rules 1 and 8, used to prune the formula search
+        :param atoms: the element names
+        :param lower_mass: the lowest formula mass
+        :param upper_mass: the highest formula mass
+        :return: a list of the maximum count of each element in atoms, INFINITE if unlimited
+        """
+        max_occurrences = dict((a, INFINITE) for a in atoms)
+
+        # rule 1 allows the largest limits of all the mass bands in [lower_mass, upper_mass], 
+        # and nothing at all if that goes above the heaviest band
+        if self.rule_switch[0] and upper_mass < RULE_1_ELEMENT_LIMITS[-1][0]:
+            band_lower_mass = 0
+            for mass_limit, element_limits in RULE_1_ELEMENT_LIMITS:
+                if lower_mass < mass_limit and upper_mass >= band_lower_mass:
+                    for element, limit in zip(RULE_1_ELEMENTS, element_limits):
+                        if element in max_occurrences:
+                            if max_occurrences[element] == INFINITE:
+                                max_occurrences[element] = limit
+                            else:
+                                max_occurrences[element] = max(max_occurrences[element], limit)
+                band_lower_mass = mass_limit
+
+        if self.rule_switch[7] and self.rule_8_max_occurrences is not None:
+            for element in self.rule_8_max_occurrences:
+                if element in max_occurrences:
+                    max_occurrences[element] = min(max_occurrences[element], self.rule_8_max_occurrences[element])
+
+        return [max_occurrences[a] for a in atoms]
+
+    def filter_matrix(self, counts, atoms, diagnostic=None):
+        """
+        vectorised version of filter_formula for many formulas at once. Rules 3 and 7 are 
+        not implemented and always pass. Elements missing from atoms count as zero.
+        :param counts: an (N, len(atoms)) matrix of element counts, one formula per row
+        :param atoms: the element names of the columns of counts
+        :param diagnostic: overrides the diagnostic mode of this object if not None
+        :return: a boolean mask of the formulas that pass all the enabled rules, and in 
+        diagnostic mode an (N, n_enabled_rules) boolean matrix of the result of every 
+        enabled rule, None otherwise
+        """
+        rules = [self.rule1_matrix, self.rule2_matrix, self.rule3_matrix, self.rule4_matrix, 
+                 self.rule5_matrix, self.rule6_matrix, self.rule7_matrix, self.rule8_matrix]
+        if diagnostic is None:
+            diagnostic = self.diagnostic
+        if not diagnostic:
+
+            # each rule is only checked on the formulas that passed the previous ones
+            alive = np.arange(len(counts))
+            for i in self.rule_order:
+                if len(alive) == 0:
+                    break
+                passed = rules[i](counts[alive], atoms)
+                self.evaluations[i] += len(alive)
+                self.rejections[i] += len(alive) - np.count_nonzero(passed)
+                alive = alive[passed]
+            self._count_filtered(len(counts))
+            result = np.zeros(len(counts), dtype=bool)
+            result[alive] = True
+            return result, None
+
+        breakdown = []
+        for switch, rule in zip(self.rule_switch, rules):
+            if switch:
+                breakdown.append(rule(counts, atoms))
+        if breakdown:
+            breakdown = np.column_stack(breakdown)
+        else:
+            breakdown = np.ones((len(counts), 0), dtype=bool)
+        result = breakdown.all(axis=1)
+        return result, breakdown
+
+    def _count_filtered(self, n):
+        """
+        reorders the rules by decreasing rejection rate per unit of cost every 
+        RULE_REORDER_INTERVAL formulas filtered
+        """
+        self.since_reorder += n
+        if self.since_reorder < RULE_REORDER_INTERVAL:
+            return
+        self.since_reorder = 0
+
+        # rules that were never evaluated get an even chance
+        def priority(i):
+            rate = (self.rejections[i] + 1.0) / (self.evaluations[i] + 2.0)
+            return -rate / RULE_COSTS[i]
+        self.rule_order = sorted(self.enabled_rules, key=priority)
+
+    def _get_columns(self, counts, atoms, elements):
+        zeros = np.zeros(len(counts), dtype=counts.dtype)
+        columns = []
+        for element in elements:
+            if element in atoms:
+                columns.append(counts[:, atoms.index(element)])
+            else:
+                columns.append(zeros)
+        return columns
+
+    def rule1_matrix(self, counts, atoms):
+        """
+        vectorised rule1
+        :return: a boolean array, True for the formulas that pass this test
+        """
+        masses = counts.dot(np.array([self.masses[a] for a in atoms]))
+        columns = self._get_columns(counts, atoms, RULE_1_ELEMENTS)
+        passed = np.ones(len(counts), dtype=bool)
+        lighter = np.zeros(len(counts), dtype=bool)
+        for mass_limit, element_limits in RULE_1_ELEMENT_LIMITS:
+            in_band = (masses < mass_limit) & ~lighter
+            for column, limit in zip(columns, element_limits):
+                passed &= ~(in_band & (column > limit))
+            lighter |= in_band
+        return passed
+
+    def rule2_matrix(self, counts, atoms):
+        """
+        vectorised rule2
+        :return: a boolean array, True for the formulas that pass this test
+        """
+        valence_sum = counts.dot(np.array([self.valences[a] for a in atoms]))
+        n_atoms = counts.sum(axis=1)
+        return (valence_sum % 2 == 0) & (valence_sum >= 2 * (n_atoms - 1))
+
+    def rule3_matrix(self, counts, atoms):
+        return np.ones(len(counts), dtype=bool)
+
+    def rule4_matrix(self, counts, atoms):
+        """
+        vectorised rule4
+        :return: a boolean array, True for the formulas that pass this test
+        """
+        c, h = self._get_columns(counts, atoms, ['C', 'H'])
+        checked = (c > 0) & (h > 0)
+        h_c_ratio = h / np.where(checked, c, 1).astype(float)
+        return ~checked | ((6 > h_c_ratio) & (h_c_ratio > 0.1))
+
+    def rule5_matrix(self, counts, atoms):
+        """
+        vectorised rule5, the ratios are integer divisions as in rule5
+        :return: a boolean array, True for the formulas that pass this test
+        """
+        c, n, o, p, s = self._get_columns(counts, atoms, ['C', 'N', 'O', 'P', 'S'])
+        checked = c > 0
+        c = np.where(checked, c, 1)
+        return ~checked | ((4 > n // c) & (3 > o // c) & (2 > p // c) & (3 > s // c))
+
+    def rule6_matrix(self, counts, atoms):
+        """
+        vectorised rule6
+        :return: a boolean array, True for the formulas that pass this test
+        """
+        n, o, p, s = self._get_columns(counts, atoms, ['N', 'O', 'P', 'S'])
+        failed = ((n > 1) & (o > 1) & (p > 1) & (s > 1) & ~((n < 10) & (o < 20) & (p < 4) & (s < 3))) | \
+                 ((n > 3) & (p > 3) & ~((n < 11) & (o < 22) & (p < 6))) | \
+                 ((o > 1) & (p > 1) & (s > 1) & ~((o < 14) & (p < 3) & (s < 3))) | \
+                 ((n > 1) & (p > 1) & (s > 1) & ~((p < 3) & (s < 3) & (n < 4))) | \
+                 ((n > 6) & (o > 6) & (s > 6) & ~((n < 19) & (o < 14) & (s < 8)))
+        return ~failed
+
+    def rule7_matrix(self, counts, atoms):
+        return np.ones(len(counts), dtype=bool)
+
+    def rule8_matrix(self, counts, atoms):
+        """
+        vectorised rule8
+        :return: a boolean array, True for the formulas that pass this test
+        """
+        max_occurrences = self.max_occurrences
+
+        passed = np.ones(len(counts), dtype=bool)
+        for i, a in enumerate(atoms):
+            if a in max_occurrences:
+                passed &= counts[:, i] <= max_occurrences[a]
+        return passed
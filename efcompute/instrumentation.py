@@ -0,0 +1,63 @@
+import sys
+import heapq
+from collections import namedtuple
+
+# the counters of the search of one mass, given to the instrumentation callback of ef_assigner.
+# int_masses is the number of integer masses decomposed, nodes the number of nodes of the
+# decomposition trees visited, candidates the number of formulas within the mass tolerance
+# and after_rules how many of them passed the golden rules. In batch mode, the integer masses
+# shared by several queries count for each of them.
+search_counters = namedtuple('search_counters', ['query', 'n_queries', 'precursor_mass', 'ppm', 'int_masses',
+                                                 'nodes', 'candidates', 'after_rules', 'elapsed_ns', 'top_hit'])
+
+class verbose_printer(object):
+    ''' Prints the progress of the search of every mass that has a top hit, the output of
+        ef_assigner when verbose is on '''
+
+    def __call__(self, counters):
+        if counters.after_rules > 0:
+            print "Searching for neutral mass %f (%d/%d) at tolerance %d ppm" % (counters.precursor_mass,
+                                                                                 counters.query+1,
+                                                                                 counters.n_queries,
+                                                                                 counters.ppm)
+            print "- found " + str(counters.candidates) + " candidate(s), best formula = " + counters.top_hit
+            sys.stdout.flush()
+
+class search_summary(object):
+    ''' Adds up the counters of all the masses searched, and keeps the slowest ones '''
+
+    def __init__(self, n_slowest=10):
+        self.n_slowest = n_slowest
+        self.masses = 0
+        self.totals = dict((field, 0) for field in ['int_masses', 'nodes', 'candidates', 'after_rules', 'elapsed_ns'])
+        self.slowest = []
+        self.order = 0
+
+    def __call__(self, counters):
+        self.masses += 1
+        for field in self.totals:
+            self.totals[field] += getattr(counters, field)
+        item = (counters.elapsed_ns, -self.order, counters)
+        self.order += 1
+        if len(self.slowest) < self.n_slowest:
+            heapq.heappush(self.slowest, item)
+        elif item > self.slowest[0]:
+            heapq.heapreplace(self.slowest, item)
+
+    def get_slowest(self):
+        ''' Returns the counters of the slowest masses, the slowest first '''
+        return [item[2] for item in sorted(self.slowest, reverse=True)]
+
+    def report(self):
+        ''' Returns the summary as a printable string '''
+
+        lines = ["%d masses searched in %.3fs" % (self.masses, self.totals['elapsed_ns']/1e9)]
+        for field in ['int_masses', 'nodes', 'candidates', 'after_rules']:
+            lines.append("- %s: %d in total, %.1f per mass" % (field, self.totals[field],
+                                                               self.totals[field]/float(max(self.masses, 1))))
+        lines.append("- slowest masses:")
+        for counters in self.get_slowest():
+            lines.append("  %f: %.3fs, %d integer masses, %d nodes, %d candidates, %d after rules" % (
+                counters.precursor_mass, counters.elapsed_ns/1e9, counters.int_masses, counters.nodes,
+                counters.candidates, counters.after_rules))
+        return '\n'.join(lines)
@@ -0,0 +1,65 @@
+import numpy as np
+
+from ef_constants import ISOTOPE_ABUNDANCES
+
+class isotope_scorer(object):
+    '''
+    Computes the theoretical M+0, M+1 and M+2 isotope envelopes of the formulas of a count
+    matrix, and scores them against observed isotope intensities.
+
+    For every atom, a table holds the envelope of n atoms of that element for n = 0, 1, ...,
+    so the envelope of a formula is the convolution of one row of each table. Both the
+    lookups and the convolutions are done on whole columns of the count matrix at once.
+    '''
+
+    def __init__(self, abundances=ISOTOPE_ABUNDANCES):
+        self.abundances = abundances
+        self.tables = {}
+
+    def get_envelopes(self, counts, atoms):
+        ''' Returns the (n, 3) array of the M+0, M+1 and M+2 intensities of the formulas in 
+            counts, whose columns are the atoms, relative to their sum '''
+
+        envelopes = np.zeros((len(counts), 3))
+        envelopes[:, 0] = 1.0
+        for i, a in enumerate(atoms):
+            column = counts[:, i]
+            if len(column) == 0 or column.max() == 0:
+                continue
+            element = self._get_table(a, column.max())[column]
+            envelopes = self._convolve(envelopes, element)
+        return envelopes / envelopes.sum(axis=1)[:, None]
+
+    def score(self, counts, atoms, observed):
+        ''' Returns the similarity in [0, 1] of the envelope of every formula in counts with the 
+            observed M+0, M+1 and M+2 intensities, as one minus their total variation distance.
+            The observed intensities can be in any unit, missing isotopes are given as 0. '''
+
+        observed = np.array(observed, dtype=float)
+        observed = observed / observed.sum()
+        envelopes = self.get_envelopes(counts, atoms)
+        return 1.0 - 0.5*np.abs(envelopes - observed).sum(axis=1)
+
+    def _get_table(self, atom, max_count):
+        ''' Returns the table of the envelopes of 0 to at least max_count atoms, each one made 
+            from the previous one by adding one atom '''
+
+        table = self.tables.get(atom)
+        if table is None or len(table) <= max_count:
+            n = max(max_count+1, 2*len(table) if table is not None else 64)
+            one_atom = np.array([self.abundances[atom]])
+            table = np.zeros((n, 3))
+            table[0, 0] = 1.0
+            for i in range(1, n):
+                table[i] = self._convolve(table[i-1:i], one_atom)[0]
+            self.tables[atom] = table
+        return table
+
+    def _convolve(self, x, y):
+        ''' Convolves the rows of x and y, keeping M+0 to M+2 '''
+
+        result = np.empty((len(x), 3))
+        result[:, 0] = x[:, 0]*y[:, 0]
+        result[:, 1] = x[:, 0]*y[:, 1] + x[:, 1]*y[:, 0]
+        result[:, 2] = x[:, 0]*y[:, 2] + x[:, 1]*y[:, 1] + x[:, 2]*y[:, 0]
+        return result
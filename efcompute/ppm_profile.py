@@ -0,0 +1,48 @@
+import numpy as np
+
+PPM_PROFILE_MODES = ('step', 'linear')
+
+class ppm_profile(object):
+    '''
+    A mass tolerance in ppm that depends on the mass, given at increasing mass breakpoints.
+
+    In 'step' mode, the masses up to breakpoints[0] get tolerances[0], the masses in
+    (breakpoints[i-1], breakpoints[i]] get tolerances[i], and the masses above the last
+    breakpoint get the last tolerance. In 'linear' mode, the tolerance is interpolated
+    linearly between the breakpoints and is constant beyond the first and last ones.
+    '''
+
+    def __init__(self, breakpoints, tolerances, mode='step'):
+        if mode not in PPM_PROFILE_MODES:
+            raise ValueError("Unknown ppm profile mode " + str(mode) + ", expected one of " +
+                             str(PPM_PROFILE_MODES))
+        if len(breakpoints) == 0 or len(breakpoints) != len(tolerances):
+            raise ValueError("A ppm profile needs the same number (> 0) of breakpoints and tolerances")
+        self.breakpoints = np.array(breakpoints, dtype=float)
+        self.tolerances = np.array(tolerances, dtype=float)
+        if np.any(np.diff(self.breakpoints) <= 0):
+            raise ValueError("The breakpoints of a ppm profile must be strictly increasing")
+        self.mode = mode
+
+    @staticmethod
+    def from_list(ppm_list, mode='step'):
+        ''' Makes a profile from a list of (mass, ppm) pairs, the conditional tolerance
+            format of ef_assigner.find_formulas '''
+        breakpoints = [item[0] for item in ppm_list]
+        tolerances = [item[1] for item in ppm_list]
+        return ppm_profile(breakpoints, tolerances, mode)
+
+    def get_ppm(self, masses):
+        ''' Returns the array of tolerances of all the masses at once '''
+
+        masses = np.asarray(masses, dtype=float)
+        if self.mode == 'step':
+            pos = np.searchsorted(self.breakpoints, masses, side='left')
+            pos = np.minimum(pos, len(self.breakpoints)-1)
+            return self.tolerances[pos]
+        else:
+            return np.interp(masses, self.breakpoints, self.tolerances)
+
+    def __repr__(self):
+        return "ppm_profile mode=%s breakpoints=%s tolerances=%s" % (self.mode, self.breakpoints.tolist(),
+                                                                    self.tolerances.tolist())
@@ -0,0 +1,114 @@
+import numpy as np
+
+from ef_assigner import ef_assigner
+from golden_rules import golden_rules
+from element_alphabet import element_alphabet
+from ef_constants import ATOM_MASSES, PROTON_MASS, INFINITE
+
+# some known molecules over H, C, N, O, P and S, and their formulas
+KNOWN_FORMULAS = [('alanine',         {'C': 3, 'H': 7,  'N': 1, 'O': 2}),
+                  ('cysteine',        {'C': 3, 'H': 7,  'N': 1, 'O': 2, 'S': 1}),
+                  ('glucose',         {'C': 6, 'H': 12, 'O': 6}),
+                  ('phosphoserine',   {'C': 3, 'H': 8,  'N': 1, 'O': 6, 'P': 1}),
+                  ('caffeine',        {'C': 8, 'H': 10, 'N': 4, 'O': 2}),
+                  ('methionine',      {'C': 5, 'H': 11, 'N': 1, 'O': 2, 'S': 1})]
+
+def get_formula_mass(formula):
+    return sum(ATOM_MASSES[a]*formula[a] for a in formula)
+
+def brute_force_formulas(atoms, max_mass):
+    ''' Every formula over atoms up to max_mass, as a count matrix and the vector of their masses,
+        built one atom at a time without any of the ef_assigner machinery '''
+    atom_masses = np.array([ATOM_MASSES[a] for a in atoms])
+    counts = np.zeros((1, 0), dtype=np.int32)
+    masses = np.zeros(1)
+    for i, a in enumerate(atoms):
+        n = np.arange(int(max_mass / atom_masses[i]) + 1)
+        counts = np.hstack([np.repeat(counts, len(n), axis=0), np.tile(n, len(counts))[:, None]])
+        masses = np.repeat(masses, len(n)) + np.tile(n, len(masses))*atom_masses[i]
+        counts, masses = counts[masses <= max_mass], masses[masses <= max_mass]
+    return counts, masses
+
+def brute_force_round_robin(a):
+    ''' The round-robin table of the integer masses a, from the masses reachable over the first
+        i+1 of them by dynamic programming '''
+    a1 = a[0]
+    bound = a1*max(a)
+    reachable = np.zeros(bound, dtype=bool)
+    reachable[0] = True
+    rr = np.empty((len(a), a1), dtype=np.int64)
+    for i, ai in enumerate(a):
+        for start in range(ai, bound, ai):
+            end = min(start + ai, bound)
+            reachable[start:end] |= reachable[start-ai:end-ai]
+        smallest = np.empty(a1, dtype=np.int64)
+        smallest.fill(INFINITE)
+        found = np.flatnonzero(reachable)
+        np.minimum.at(smallest, found % a1, found)
+        rr[i] = smallest
+    return rr
+
+def test_round_robin():
+    for names, scale_factor in [(['H', 'C', 'N', 'O'], 100), (['H', 'C', 'N', 'O', 'P', 'S'], 100),
+                                (['H', 'C', 'O'], 1000)]:
+        alphabet = element_alphabet.from_names(names)
+        a = alphabet.get_dictionary(scale_factor)
+        rr = alphabet.get_round_robin(scale_factor)
+        expected = brute_force_round_robin(a)
+        print "Round-robin table of %s at scale factor %d: %s" % (names, scale_factor,
+                                                                   (rr == expected).all())
+        assert (rr == expected).all()
+
+def test_find_formulas():
+
+    # wide enough for several candidates per mass
+    ppm = 20
+    masses = [get_formula_mass(formula) for name, formula in KNOWN_FORMULAS]
+    for scale_factor in [100, 1000]:
+        ef = ef_assigner(scale_factor=scale_factor, verbose=False)
+
+        # all the formulas within ppm of each mass that pass the same golden rules
+        all_counts, all_masses = brute_force_formulas(ef.atoms, max(masses) + 1)
+        passed, breakdown = golden_rules(ef.gr.rule_switch).filter_matrix(all_counts, ef.atoms)
+        all_counts, all_masses = all_counts[passed], all_masses[passed]
+
+        for options in [dict(), dict(batch_mode=True)]:
+            formulas_out, top_hit_string, precursor_mass_list = ef.find_formulas(masses, ppm=ppm,
+                                                                                 polarisation="none",
+                                                                                 **options)
+            for (name, formula), mass, top_hit in zip(KNOWN_FORMULAS, masses, top_hit_string):
+                within = np.abs(all_masses - mass)/mass <= 1e-6*ppm
+                expected = set(tuple(row) for row in all_counts[within].tolist())
+                found = set(tuple(f[a] for a in ef.atoms) for f in formulas_out[mass])
+                print "%s at scale factor %d %s: %d candidate(s), top hit %s" % (name, scale_factor, options,
+                                                                                len(found), top_hit)
+                assert found == expected
+                assert tuple(formula.get(a, 0) for a in ef.atoms) in found
+
+        # the protonated masses give the same candidates, with one more H
+        formulas_out, top_hit_string, precursor_mass_list = ef.find_formulas([m + PROTON_MASS for m in masses],
+                                                                             ppm=ppm, polarisation="pos")
+        for (name, formula), precursor_mass in zip(KNOWN_FORMULAS, precursor_mass_list):
+            charged = dict(formula)
+            charged['H'] += 1
+            assert charged in [dict((a, f[a]) for a in f if f[a] > 0) for f in formulas_out[precursor_mass]]
+
+def test_rounding_error_pruning():
+
+    masses = [get_formula_mass(formula) for name, formula in KNOWN_FORMULAS]
+    for scale_factor in [100, 1000]:
+        ef = ef_assigner(scale_factor=scale_factor, verbose=False)
+        pruned = ef_assigner(scale_factor=scale_factor, verbose=False, track_rounding_error=True)
+        formulas_out = ef.find_formulas(masses, ppm=5, polarisation="none")[0]
+        pruned_out = pruned.find_formulas(masses, ppm=5, polarisation="none")[0]
+        for mass in masses:
+            assert sorted(sorted(f.items()) for f in formulas_out[mass]) == \
+                   sorted(sorted(f.items()) for f in pruned_out[mass])
+        print "Rounding error pruning at scale factor %d gives the same candidates" % scale_factor
+
+def main():
+    test_round_robin()
+    test_find_formulas()
+    test_rounding_error_pruning()
+
+if __name__ == "__main__": main()